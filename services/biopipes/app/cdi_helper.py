@@ -4,9 +4,15 @@ whether new data exists.
 '''
 
 import os
+import time
+import json
+import base64
 import logging
 import datetime
+import threading
 import requests
+import urllib3
+from concurrent.futures import ThreadPoolExecutor
 # Special SDN python library auto generated from OpenAPI standards
 import cdi_sdn_py 
 # from sdnclient.api import InfoApi
@@ -25,27 +31,69 @@ from cdi_sdn_py.model.order_details_return import OrderDetailsReturn
 
 log = logging.getLogger('cdi_helper') 
 
-#Python class to handle the connection to the API and to reconnect when auth fails
-class SeadatanetAPI:
-    def __init__(self, retry = True, retries = 3, retry_interval = 5, host = "https://seadatanet-buffer5.maris.nl/api_v5.1"):
-        self.retry = retry
-        self.retries = retries
-        self.retry_interval = retry_interval
+DEFAULT_HOST = "https://seadatanet-buffer5.maris.nl/api_v5.1"
+
+
+def query_key(query):
+    '''
+    Canonical text of a job query, identical queries get the same key
+    '''
+    return json.dumps({key: value for (key, value) in (query or {}).items() if value is not None}, sort_keys=True)
+
+
+class TokenManager:
+    '''
+    Keeps the login token of the Seadatanet API with its expiry. The token is
+    cached in a JSON file (SDN_TOKEN_CACHE, next to the trigger DB by default)
+    so restarts and the conversion processes reuse it instead of logging in,
+    and it is refreshed SDN_TOKEN_REFRESH_SECS before it expires. The expiry
+    comes from the token itself when it's a JWT, otherwise the token is
+    assumed to be valid for SDN_TOKEN_TTL_MINS. The token is set on the
+    given API client configuration when it changes, under the lock, so the
+    threads sharing the client don't overwrite it with older tokens.
+    '''
+    def __init__(self, host, configuration=None):
         self.host = host
+        self.configuration = configuration
+        self.username = os.getenv('USERNAME', '')
+        db_file = os.getenv('SQLITE_DATABASE','/etc/sqlite/trigger.db')
+        default_path = os.path.join(os.path.dirname(db_file), 'sdn_token.json')
+        self.cache_path = os.getenv('SDN_TOKEN_CACHE', default_path)
+        self.refresh_secs = int(os.getenv('SDN_TOKEN_REFRESH_SECS', 300))
+        self.lock = threading.Lock()
+        self.token = None
+        self.expires = 0
+        self.load()
 
-        self.get_token()
-        self.configuration = cdi_sdn_py.Configuration(host = self.host,
-                                                      access_token = self.token)
-        
-    def get_token(self):
+    def get(self, force=False):
+        '''
+        Return a token that is valid for a while yet, logging in if needed.
+        force logs in again, for when the API refused the current token.
+        '''
+        with self.lock:
+            if force or self.token is None or time.time() > self.expires - self.refresh_secs:
+                self.login()
+            return self.token
+
+    def invalidate(self, token):
+        '''
+        Log in again, unless another thread already replaced the refused token
+        '''
+        with self.lock:
+            if token == self.token:
+                self.login()
+            return self.token
+
+    def login(self):
         '''
         Get the token from the Seadatanet API with username and password stored in env variables
         '''
-        with cdi_sdn_py.ApiClient() as api_client:
+        log.info('Logging in to the Seadatanet API...')
+        with cdi_sdn_py.ApiClient(cdi_sdn_py.Configuration(host = self.host)) as api_client:
             # Create an instance of the API class
             api_instance = security_api.SecurityApi(api_client)
             login = Login(
-                username=os.getenv('USERNAME', ''),
+                username=self.username,
                 password=os.getenv('PASSWORD', ''),
             ) 
             try:
@@ -53,14 +101,165 @@ class SeadatanetAPI:
                 api_response = api_instance.login_post(login)
             except cdi_sdn_py.ApiException as e:
                 log.warning("Exception when calling SecurityApi->login_post: %s\n" % e)
-        self.token = api_response['token']
-        return self.token
+                raise
+        self.set_token(api_response['token'], token_expiry(api_response['token']))
+        self.save()
+
+    def load(self):
+        '''
+        Read the cached token, if it's for the same host and user
+        '''
+        try:
+            with open(self.cache_path) as f:
+                cached = json.load(f)
+        except (OSError, ValueError):
+            return
+        if cached.get('host') == self.host and cached.get('username') == self.username:
+            self.set_token(cached.get('token'), cached.get('expires', 0))
+
+    def set_token(self, token, expires):
+        self.token = token
+        self.expires = expires
+        if self.configuration is not None:
+            self.configuration.access_token = token
+
+    def save(self):
+        '''
+        Cache the token, through a temp file since other processes read it
+        '''
+        cached = {'host': self.host, 'username': self.username, 'token': self.token, 'expires': self.expires}
+        tmp_path = f'{self.cache_path}.{os.getpid()}.tmp'
+        try:
+            with open(os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as f:
+                json.dump(cached, f)
+            os.replace(tmp_path, self.cache_path)
+        except OSError as e:
+            log.warning('Could not cache the API token: {0}'.format(e))
+
+def token_expiry(token):
+    '''
+    The expiry (epoch seconds) of a token, from the exp claim of a JWT or
+    SDN_TOKEN_TTL_MINS from now.
+    '''
+    try:
+        payload = token.split('.')[1]
+        claims = json.loads(base64.urlsafe_b64decode(payload + '=' * (-len(payload) % 4)))
+        return float(claims['exp'])
+    except (IndexError, KeyError, TypeError, ValueError):
+        return time.time() + 60 * int(os.getenv('SDN_TOKEN_TTL_MINS', 60))
+
+#Python class to handle the connection to the API and to reconnect when auth fails
+#Every call is retried with an exponential backoff (retries, retry_interval) on
+#connection problems and server errors, and once with a new token on a 401.
+#One instance is meant to be shared by all the jobs: the API calls go through a
+#single pooled ApiClient and the downloads through a single requests session, so
+#connections are kept alive between calls instead of reconnecting every time.
+class SeadatanetAPI:
+    def __init__(self, retry = True, retries = 3, retry_interval = 5, host = None, pool_size = None):
+        self.retry = retry
+        self.retries = retries
+        self.retry_interval = retry_interval
+        # SDN_API_HOST can point to a local mock of the API for testing
+        self.host = host or os.getenv('SDN_API_HOST', DEFAULT_HOST)
+        self.pool_size = pool_size or int(os.getenv('SDN_API_POOL_SIZE', 8))
+
+        self.configuration = cdi_sdn_py.Configuration(host = self.host)
+        self.configuration.connection_pool_maxsize = self.pool_size
+        self.api_client = cdi_sdn_py.ApiClient(self.configuration)
+
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+        self.tokens = TokenManager(self.host, self.configuration)
+
+        # Cache of the last update per query, see get_last_update
+        self.probe_page_size = int(os.getenv('SDN_PROBE_PAGE_SIZE', 1))
+        self.probe_cache_secs = int(os.getenv('SDN_PROBE_CACHE_SECS', 60))
+        self.probe_cache = {}
+        self.probe_lock = threading.Lock()
+        self.probe_key_locks = {}
+
+    @property
+    def token(self):
+        return self.tokens.get()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        '''
+        Close the pooled connections
+        '''
+        self.api_client.close()
+        self.session.close()
+
+    def get_token(self):
+        '''
+        Log in again and return the new token
+        '''
+        return self.tokens.get(force=True)
+
+    def call(self, func, *args, **kwargs):
+        '''
+        Make an API call with a valid token. A 401 logs in again and retries
+        once, connection problems and server errors are retried with
+        a backoff when retry is set.
+        '''
+        reauthenticated = False
+        attempt = 0
+        while True:
+            # Also brings the token of the configuration up to date
+            token = self.tokens.get()
+            try:
+                return func(*args, **kwargs)
+            except cdi_sdn_py.ApiException as e:
+                if e.status == 401 and not reauthenticated:
+                    log.info('API token refused, logging in again...')
+                    self.tokens.invalidate(token)
+                    reauthenticated = True
+                    continue
+                if not (self.retry and attempt < self.retries and (e.status is None or e.status == 429 or e.status >= 500)):
+                    raise
+                error = e
+            except (urllib3.exceptions.HTTPError, requests.RequestException, OSError) as e:
+                if not (self.retry and attempt < self.retries):
+                    raise
+                error = e
+            wait = self.retry_interval * 2**attempt
+            log.warning('API call failed, retrying in {0}s: {1}'.format(wait, error))
+            time.sleep(wait)
+            attempt += 1
 
     def get_last_update(self,job_dict):
         '''
-        Return the most recent update timestamp for a dataset query dict
+        Return the most recent update timestamp for the query of a job. Results
+        are cached for SDN_PROBE_CACHE_SECS, so jobs with identical queries
+        checked in the same cycle share a single API call.
+        '''
+        key = query_key(job_dict.get('query'))
+        with self.probe_lock:
+            key_lock = self.probe_key_locks.setdefault(key, threading.Lock())
+        # Concurrent probes of the same query wait for the first one
+        with key_lock:
+            cached = self.probe_cache.get(key)
+            if cached is not None and cached[0] > time.monotonic():
+                log.debug('Using cached last update for query: %s' % key)
+                return cached[1]
+            last_update = self.query_last_update(job_dict.get('query'))
+            self.probe_cache[key] = (time.monotonic() + self.probe_cache_secs, last_update)
+            return last_update
+
+    def query_last_update(self, query):
+        '''
+        Return the most recent update timestamp for a dataset query dict, None
+        if it has no records. Only the first record (sorted on last_update) is
+        asked for. A failed query raises, it says nothing about the records.
         '''
-        query = job_dict.get('query')
         # free_text = str(query.get('free_search'))
         # originator_edmo = str(query.get('originator_edmo'))
         
@@ -72,52 +271,51 @@ class SeadatanetAPI:
         # from https://stackoverflow.com/questions/23484091/pass-kwargs-if-not-none
 
 
-        with cdi_sdn_py.ApiClient(self.configuration) as api_client:
-            # Create an instance of the API class
-            api_instance = metadata_api.MetadataApi(api_client)
-            metadata_query = MetadataQuery( 
-                pagination_sort="last_update",
-                pagination_sort_type="desc",
-                pagination_page=1,
-                pagination_count=0,
-                query_fields=OrderQueryQueryFields(**{key:value for (key,value) in query.items() if value is not None}))   
-            try:
-                # Make a query and get the metadata back
-                log.debug("Making query: %s" % metadata_query)
-                api_response = api_instance.metadata_query_post(metadata_query,_check_return_type = False )
-                log.debug('API response %s', api_response)
-                if api_response['records_found'] == 0:
-                    log.warning('No records found for query: %s' % query)
-                else:  
-                    first_row = next(iter(api_response.get('result')),None)
-                    last_update = first_row.get('last_update',None)
-                    log.debug('First row %s', first_row)
-                    if last_update is not None:
-                        last_update = datetime.datetime.strptime(last_update, '%Y-%m-%dT%H:%M:%S.%fZ')
-                    return last_update
-            except cdi_sdn_py.ApiException as e:
-                log.warning('Issue with API query: {0}'.format(e))
-                return None
-           
+        # Create an instance of the API class on the shared client
+        api_instance = metadata_api.MetadataApi(self.api_client)
+        metadata_query = MetadataQuery( 
+            pagination_sort="last_update",
+            pagination_sort_type="desc",
+            pagination_page=1,
+            pagination_count=self.probe_page_size,
+            query_fields=OrderQueryQueryFields(**{key:value for (key,value) in query.items() if value is not None}))   
+        try:
+            # Make a query and get the metadata back
+            log.debug("Making query: %s" % metadata_query)
+            api_response = self.call(api_instance.metadata_query_post, metadata_query,_check_return_type = False )
+            log.debug('API response %s', api_response)
+            if api_response['records_found'] == 0:
+                log.warning('No records found for query: %s' % query)
+            else:  
+                first_row = next(iter(api_response.get('result')),None)
+                last_update = first_row.get('last_update',None)
+                log.debug('First row %s', first_row)
+                if last_update is not None:
+                    last_update = datetime.datetime.strptime(last_update, '%Y-%m-%dT%H:%M:%S.%fZ')
+                return last_update
+        except cdi_sdn_py.ApiException as e:
+            log.warning('Issue with API query: {0}'.format(e))
+            raise
+
     def get_order(self,job_dict):
         '''
         Get details on the order and the download URL if available
         '''
         order_number = job_dict.get('order_id')
         
-        with cdi_sdn_py.ApiClient(self.configuration) as api_client:
-            # Create an instance of the API class
-            api_instance = orders_api.OrdersApi(api_client) 
+        # Create an instance of the API class on the shared client
+        api_instance = orders_api.OrdersApi(self.api_client) 
 
-            # example passing only required values which don't have defaults set
-            try:
-                # Find order by Ordernumber
-                api_response = api_instance.order_order_number_get(order_number, _check_return_type = False )
-                log.debug('API response %s', api_response)
-                return api_response
-            except cdi_sdn_py.ApiException as e:
-                print("Exception when calling OrdersApi->order_order_number_get: %s\n" % e)
-                return None
+        # example passing only required values which don't have defaults set
+        try:
+            # Find order by Ordernumber
+            api_response = self.call(api_instance.order_order_number_get, order_number, _check_return_type = False )
+            log.debug('API response %s', api_response)
+            # Plain dicts/lists so the order can be handed to the conversion processes
+            return self.api_client.sanitize_for_serialization(api_response)
+        except cdi_sdn_py.ApiException as e:
+            print("Exception when calling OrdersApi->order_order_number_get: %s\n" % e)
+            return None
 
     def place_order(self, job_dict):
         query = job_dict.get('query')
@@ -128,39 +326,156 @@ class SeadatanetAPI:
         motivation = str(job_dict.get('motivation','dataset update'))
         data_format_l24 = str(job_dict.get('data_format_l24','bodv'))
 
-        with cdi_sdn_py.ApiClient(self.configuration) as api_client:
-            # Create an instance of the API class
-            api_instance = orders_api.OrdersApi(api_client)
-            order_query = OrderQuery(
-                user_order_name=user_order_name,
-                motivation=motivation,
-                data_format_l24=data_format_l24,
-                query_fields=OrderQueryQueryFields(**{key:value for (key,value) in query.items() if value is not None}))  
-            try:
-                # Make an order by query
-                log.debug("Placing Order: %s" % order_query)
-                api_response = api_instance.order_query_post(order_query,  _check_return_type = False )
-                log.debug(api_response)
-                return api_response
-            except cdi_sdn_py.ApiException as e:
-                print("Exception when calling OrdersApi->order_query_post: %s\n" % e)
-                return None
+        # Create an instance of the API class on the shared client
+        api_instance = orders_api.OrdersApi(self.api_client)
+        order_query = OrderQuery(
+            user_order_name=user_order_name,
+            motivation=motivation,
+            data_format_l24=data_format_l24,
+            query_fields=OrderQueryQueryFields(**{key:value for (key,value) in query.items() if value is not None}))  
+        try:
+            # Make an order by query
+            log.debug("Placing Order: %s" % order_query)
+            api_response = self.call(api_instance.order_query_post, order_query,  _check_return_type = False )
+            log.debug(api_response)
+            return api_response
+        except cdi_sdn_py.ApiException as e:
+            print("Exception when calling OrdersApi->order_query_post: %s\n" % e)
+            return None
+
+    def map_jobs(self, func, job_dicts, failed=None):
+        '''
+        Call func(job_dict) for a batch of jobs concurrently over the shared
+        connection pool. Returns {job_id: result}, failed (None by default)
+        for the jobs that failed.
+        '''
+        job_dicts = list(job_dicts)
+        results = {}
+        if not job_dicts:
+            return results
+        with ThreadPoolExecutor(max_workers=min(self.pool_size, len(job_dicts))) as pool:
+            futures = {job_dict.get('job_id'): pool.submit(func, job_dict) for job_dict in job_dicts}
+            for job_id, future in futures.items():
+                try:
+                    results[job_id] = future.result()
+                except Exception as e:
+                    log.warning('Issue with API call for job {0}: {1}'.format(job_id, e))
+                    results[job_id] = failed
+        return results
+
+    def get_last_updates(self, job_dicts):
+        '''
+        Return {job_id: last update timestamp} for a batch of jobs, with one
+        API call per distinct query, all made concurrently. The jobs whose
+        probe failed are left out, None means the query has no records.
+        '''
+        job_dicts = list(job_dicts)
+        first_jobs = {}
+        for job_dict in job_dicts:
+            first_jobs.setdefault(query_key(job_dict.get('query')), job_dict)
+        log.debug(f'Probing {len(first_jobs)} distinct queries for {len(job_dicts)} jobs...')
+        failed = object()
+        probed = self.map_jobs(self.get_last_update, first_jobs.values(), failed=failed)
+        last_updates = {job_dict.get('job_id'): probed.get(first_jobs[query_key(job_dict.get('query'))].get('job_id'))
+                        for job_dict in job_dicts}
+        return {job_id: last_update for job_id, last_update in last_updates.items() if last_update is not failed}
+
+    def get_orders(self, job_dicts):
+        '''
+        Return {job_id: order details} for a batch of jobs with placed orders
+        '''
+        return self.map_jobs(self.get_order, job_dicts)
 
     def download_order(self, url):
         '''
         This doesn't use the OpenAPI classes but makes use of the Bearer Token
-        to do a simple requests.get(). This is because the OpenAPI classes don't
-        seem to work with the Bearer Token.
+        to do a simple get() on the shared session. This is because the OpenAPI
+        classes don't seem to work with the Bearer Token.
 
         response = requests.get('https://www.example.com/', auth=BearerAuth('3pVzwec1Gs1m'))
 
         '''
         log.debug(f'Downloading {url}...')
-        headers = {"Authorization": f"Bearer {self.token}"}
+        token = self.token
         try:
-            response = requests.get(url,headers=headers)
+            response = self.session.get(url,headers={"Authorization": f"Bearer {token}"})
+            if response.status_code == 401:
+                log.info('API token refused, logging in again...')
+                token = self.tokens.invalidate(token)
+                response = self.session.get(url,headers={"Authorization": f"Bearer {token}"})
             return response
         except Exception as e:
             log.warning('Issue with order download: {0}'.format(e))
             return None
-        
\ No newline at end of file
+
+    def download_to_file(self, url, path, expected_size=None, chunk_size=1024 * 1024):
+        '''
+        Stream a download to disk. The data goes into <path>.part, which is
+        renamed to path once it's complete (and matches expected_size if that
+        is known). If a .part file is left from an earlier attempt the download
+        is resumed from there with a Range request. Dropped connections and
+        downloads that end short of expected_size are resumed up to
+        DOWNLOAD_RETRIES times. Returns the number of bytes, raises IOError
+        when the download didn't complete.
+        '''
+        part_path = f'{path}.part'
+        retries = int(os.getenv('DOWNLOAD_RETRIES', 3))
+        timeout = int(os.getenv('DOWNLOAD_TIMEOUT', 60))
+        reauthenticated = False
+        for attempt in range(retries + 1):
+            offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+            token = self.token
+            headers = {"Authorization": f"Bearer {token}"}
+            if offset:
+                headers['Range'] = f'bytes={offset}-'
+                log.info(f'Resuming download of {url} at {offset} bytes...')
+            start = time.monotonic()
+            received = 0
+            try:
+                with self.session.get(url, headers=headers, stream=True, timeout=timeout) as response:
+                    if response.status_code == 401 and not reauthenticated:
+                        log.info('API token refused, logging in again...')
+                        self.tokens.invalidate(token)
+                        reauthenticated = True
+                        continue
+                    if response.status_code == 416 and offset and offset == expected_size:
+                        # The part file was already complete
+                        pass
+                    elif response.status_code == 416:
+                        # The part file doesn't fit the file on the server (anymore)
+                        log.warning(f'Server refused to resume {url} at {offset} bytes, downloading from the start...')
+                        os.remove(part_path)
+                        continue
+                    else:
+                        response.raise_for_status()
+                        if offset and response.status_code != 206:
+                            log.info('Server ignored the Range request, downloading from the start...')
+                            offset = 0
+                        with open(part_path, 'ab' if offset else 'wb') as f:
+                            for chunk in response.iter_content(chunk_size=chunk_size):
+                                f.write(chunk)
+                                received += len(chunk)
+            except requests.RequestException as e:
+                if attempt == retries:
+                    raise
+                log.warning(f'Download of {url} interrupted after {received} bytes, retrying: {e}')
+                time.sleep(self.retry_interval * 2**attempt)
+                continue
+
+            elapsed = time.monotonic() - start
+            size = os.path.getsize(part_path)
+            log.info(f'Downloaded {received} bytes in {elapsed:.1f}s '
+                     f'({received / max(elapsed, 1e-6) / 1e6:.2f} MB/s) to {path}')
+            if expected_size is not None and size != expected_size:
+                if size > expected_size:
+                    # Not something a resume can fix, start over
+                    os.remove(part_path)
+                if attempt == retries:
+                    raise IOError(f'Downloaded {size} bytes for {path}, expected {expected_size}')
+                log.warning(f'Download of {url} ended at {size} of {expected_size} bytes, retrying...')
+                time.sleep(self.retry_interval * 2**attempt)
+                continue
+            os.replace(part_path, path)
+            return size
+        # Every attempt was used up by a refused token or resume
+        raise IOError(f'Download of {url} failed after {retries + 1} attempts')
@@ -1,24 +1,211 @@
 import os
+import json
 import logging
 import sqlite3
+import datetime
+import threading
+from contextlib import contextmanager
 from sqlite3 import Error
 import textwrap
 
+from app.job_model import Job, format_datetime, parse_datetime
+
 log = logging.getLogger('db_helper')
 
-def run_sql(sql):
+# The job columns the trigger service writes back after a check
+JOB_STATE_COLUMNS = ['order_placed', 'retrigger', 'last_run', 'last_data_file', 'last_meta_file', 'order_id']
+
+# Datetimes and dicts (the job query) are stored as text
+sqlite3.register_adapter(datetime.datetime, format_datetime)
+sqlite3.register_adapter(dict, json.dumps)
+
+class JobStore:
+    '''
+    Access to the jobs table. Every thread keeps its own connection open (the
+    scheduler and check threads would otherwise connect for every statement),
+    in WAL mode so the sql-viewer or a CLI can read and edit the jobs while the
+    trigger service writes. All statements are parameterized.
+    '''
+    def __init__(self, db_file=None):
+        self.db_file = db_file or os.getenv('SQLITE_DATABASE','/etc/sqlite/trigger.db')
+        self.local = threading.local()
+
+    def connection(self):
+        '''
+        The connection of the current thread, opened on first use. Forked
+        processes open their own instead of using the parent's.
+        '''
+        con = getattr(self.local, 'con', None)
+        if con is None or self.local.pid != os.getpid():
+            con = sqlite3.connect(self.db_file, timeout=30)
+            con.execute('PRAGMA journal_mode=WAL')
+            con.execute('PRAGMA synchronous=NORMAL')
+            con.execute('PRAGMA busy_timeout=30000')
+            self.local.con = con
+            self.local.pid = os.getpid()
+            self.local.in_transaction = False
+        return con
+
+    def execute(self, sql, params=()):
+        '''
+        Run a statement and return all the rows. Outside of a transaction
+        block the statement is committed straight away.
+        '''
+        log.debug('Running SQL: %s %s', sql, params)
+        con = self.connection()
+        cur = con.execute(sql, params)
+        result = cur.fetchall()
+        if not self.local.in_transaction:
+            con.commit()
+        return result
+
+    @contextmanager
+    def transaction(self):
+        '''
+        Group the statements in the block into a single transaction
+        '''
+        con = self.connection()
+        if self.local.in_transaction:
+            yield con
+            return
+        self.local.in_transaction = True
+        try:
+            with con:
+                yield con
+        finally:
+            self.local.in_transaction = False
+
+    def close(self):
+        con = getattr(self.local, 'con', None)
+        if con is not None:
+            con.close()
+            self.local.con = None
+
+    def select_jobs(self, where='', params=()):
+        '''
+        Read rows of the jobs table as Jobs
+        '''
+        log.debug('Reading jobs %s %s', where, params)
+        cur = self.connection().cursor()
+        cur.row_factory = Job.row_factory
+        jobs = cur.execute(f'SELECT * FROM jobs {where}', params).fetchall()
+        if not self.local.in_transaction:
+            self.connection().commit()
+        return jobs
+
+    def get_jobs(self):
+        return self.select_jobs()
+
+    def get_job(self, job_id):
+        jobs = self.select_jobs('WHERE id = ?', (job_id,))
+        return jobs[0] if jobs else None
+
+    def update_jobs(self, jobs):
+        '''
+        Write the state of a batch of jobs back in one transaction. Only the
+        changed columns of Jobs are written, Jobs without changes are skipped.
+        Plain job dicts get all of JOB_STATE_COLUMNS written.
+        '''
+        updates = []
+        for job in jobs:
+            changes = job.changes() if isinstance(job, Job) else dict(zip(JOB_STATE_COLUMNS, job_state(job)))
+            if changes:
+                updates.append((job, changes))
+        if not updates:
+            return
+        log.debug('Updating %s jobs', len(updates))
+        with self.transaction() as con:
+            for job, changes in updates:
+                sql = f"UPDATE jobs SET {', '.join(f'{x} = ?' for x in changes)} WHERE id = ?"
+                con.execute(sql, list(changes.values()) + [job.get('job_id')])
+        for job, changes in updates:
+            if isinstance(job, Job):
+                job.mark_clean()
+
+    def update_job(self, job_dict):
+        # Take the job dict and overwrite the old one in the DB.
+        self.update_jobs([job_dict])
+
+    def get_watermarks(self):
+        '''
+        The last update seen per query and when it was checked,
+        {query key: (datetime or None, datetime)}
+        '''
+        rows = self.execute('SELECT query_key, last_update, checked FROM watermarks')
+        return {key: (parse_datetime(last_update) if last_update else None, parse_datetime(checked))
+                for key, last_update, checked in rows}
+
+    def get_watermark(self, key):
+        '''
+        The (last update, checked) of one query, (None, None) if it wasn't checked yet
+        '''
+        rows = self.execute('SELECT last_update, checked FROM watermarks WHERE query_key = ?', (key,))
+        if not rows:
+            return None, None
+        last_update, checked = rows[0]
+        return (parse_datetime(last_update) if last_update else None), parse_datetime(checked)
+
+    def update_watermarks(self, last_updates):
+        '''
+        Record the last update of a batch of queries ({query key: datetime})
+        as checked now, in one transaction. None is kept for the queries
+        without records, they're checked again at the next check interval
+        like the others. Failed probes are never recorded.
+        '''
+        now = datetime.datetime.now()
+        rows = [(key, last_update, now) for key, last_update in last_updates.items()]
+        if not rows:
+            return
+        with self.transaction() as con:
+            con.executemany('''INSERT INTO watermarks(query_key, last_update, checked) VALUES (?, ?, ?)
+                               ON CONFLICT(query_key) DO UPDATE SET last_update = excluded.last_update,
+                                                                    checked = excluded.checked''', rows)
+
+    def create_job(self, job_dict):
+        # Create a new job
+        sql = '''INSERT INTO jobs
+        (name, active, order_placed, retrigger, query, last_run, last_data_file, last_meta_file, order_id, owner, owner_email)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)'''
+        params = (job_dict.get('name'),
+                  job_dict.get('active',1), job_dict.get('order_placed',0), job_dict.get('retrigger',0),
+                  job_dict.get('query'),
+                  job_dict.get('last_run','1900-01-01 00:00:00.000'),
+                  job_dict.get('last_data_file'),
+                  job_dict.get('last_meta_file'),
+                  job_dict.get('order_id',-1),
+                  job_dict.get('owner'),
+                  job_dict.get('owner_email'))
+        return self.execute(sql, params)
+
+def job_state(job_dict):
+    '''
+    The values of JOB_STATE_COLUMNS for a job
+    '''
+    return [job_dict.get('order_placed'),
+            job_dict.get('retrigger'),
+            job_dict.get('last_run'),
+            job_dict.get('last_data_file'),
+            job_dict.get('last_meta_file'),
+            job_dict.get('order_id')]
+
+_store = None
+_store_lock = threading.Lock()
+
+def get_store():
+    '''
+    The JobStore shared by the whole service
+    '''
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = JobStore()
+        return _store
+
+def run_sql(sql, params=()):
     '''
     Run a sql query on the DB
     '''
-    log.debug('Running SQL: %s', sql)
-    db_file = os.getenv('SQLITE_DATABASE','/etc/sqlite/trigger.db')
-    con = sqlite3.connect(db_file)
-    cur = con.cursor()
-    cur.execute(sql)
-    con.commit()
-    result = cur.fetchall()
-    con.close()
-    return result
+    return get_store().execute(sql, params)
 
 def create_dummy_job():
     '''
@@ -75,13 +262,34 @@ def ensure_db():
                         last_meta_file TEXT,
                         order_id INTEGER,
                         owner TEXT,
-                        owner_email TEXT
+                        owner_email TEXT,
+                        check_interval INTEGER
                         table_constraints
                     );'''
         run_sql(create_sql)
     except Error as e:
         log.warning(e)
 
+    try:
+        # Jobs tables created before check_interval existed
+        columns = [x[1] for x in run_sql('PRAGMA table_info(jobs)')]
+        if 'check_interval' not in columns:
+            log.info('Adding check_interval column to jobs table...')
+            run_sql('ALTER TABLE jobs ADD COLUMN check_interval INTEGER')
+    except Error as e:
+        log.warning(e)
+
+    try:
+        # Last update seen on the SDN API per job query, see cdi_helper.query_key
+        log.debug('Creating watermarks table...')
+        run_sql('''CREATE TABLE IF NOT EXISTS watermarks(
+                    query_key TEXT PRIMARY KEY,
+                    last_update TEXT,
+                    checked TEXT
+                );''')
+    except Error as e:
+        log.warning(e)
+
     try:
         log.debug('Inserting dummy table...')
         create_dummy_job()
@@ -117,33 +325,14 @@ def ensure_db():
 
 def update_job(job_dict):
     # Take the job dict and overwrite the old one in the DB.
-    query = f'''UPDATE jobs SET
-    order_placed = {job_dict.get('order_placed')},
-    retrigger = {job_dict.get('retrigger')},
-    last_run = '{job_dict.get('last_run')}',
-    last_data_file = '{job_dict.get('last_data_file')}',
-    last_meta_file = '{job_dict.get('last_meta_file')}',
-    order_id = {job_dict.get('order_id')}
-    WHERE id = {job_dict.get('job_id')}
-    '''
-    result = run_sql(query)
-    log.debug(result)
+    get_store().update_job(job_dict)
+
+def update_jobs(job_dicts):
+    # Write a batch of jobs back in one transaction
+    get_store().update_jobs(job_dicts)
 
 def create_job(job_dict):
     # Create a new job
-    query = f'''INSERT INTO jobs 
-    (name, active, order_placed, retrigger, query, last_run, last_data_file, last_meta_file, order_id, owner, owner_email)
-    VALUES
-    ('{job_dict.get('name')}',
-     {job_dict.get('active',1)},{job_dict.get('order_placed',0)},{job_dict.get('retrigger',0)},
-    '{job_dict.get('query')}',
-    '{job_dict.get('last_run','1900-01-01 00:00:00.000')}',
-    '{job_dict.get('last_data_file')}',
-    '{job_dict.get('last_meta_file')}',
-    {job_dict.get('order_id',-1)},
-    '{job_dict.get('owner')}',
-    '{job_dict.get('owner_email')}');'''
-    result = run_sql(query)
-    log.info(result) 
-
-    return result
\ No newline at end of file
+    result = get_store().create_job(job_dict)
+    log.info(result)
+    return result
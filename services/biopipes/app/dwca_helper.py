@@ -0,0 +1,172 @@
+'''
+Writes the Darwin Core Archive of a conversion, an event core with the
+occurrence and extended measurement or fact extensions:
+
+> ./<some-file>/dwc/dwca.zip
+>     meta.xml
+>     eml.xml
+>     event.txt
+>     occurrence.txt
+>     extendedmeasurementorfact.txt
+
+The tables are streamed into the zip one after the other, from the
+dataframes or from the csv files already written. The CSVs are written
+with pyarrow (DWCA_CSV_ENGINE=arrow), or with pandas in chunks of
+DWCA_CSV_CHUNK_ROWS rows when pyarrow isn't there or DWCA_CSV_ENGINE=pandas.
+Both give the same values, pyarrow quotes all the text fields.
+'''
+
+import os
+import io
+import shutil
+import logging
+import zipfile
+import datetime
+from xml.sax.saxutils import escape, quoteattr
+
+import pandas as pd
+
+import app.store_helper as store_helper
+
+log = logging.getLogger('dwca_helper')
+
+# table -> (file in the archive, row type)
+ARCHIVE_TABLES = {'event': ('event.txt', 'http://rs.tdwg.org/dwc/terms/Event'),
+                  'occ': ('occurrence.txt', 'http://rs.tdwg.org/dwc/terms/Occurrence'),
+                  'emof': ('extendedmeasurementorfact.txt', 'http://rs.iobis.org/obis/terms/ExtendedMeasurementOrFact')}
+
+DWC_NS = 'http://rs.tdwg.org/dwc/terms/'
+TERM_NAMESPACES = {'type': 'http://purl.org/dc/terms/',
+                   'modified': 'http://purl.org/dc/terms/',
+                   'measurementTypeID': 'http://rs.iobis.org/obis/terms/',
+                   'measurementValueID': 'http://rs.iobis.org/obis/terms/',
+                   'measurementUnitID': 'http://rs.iobis.org/obis/terms/'}
+
+CORE_ID = 'eventID'
+
+
+def term_uri(column):
+    return TERM_NAMESPACES.get(column, DWC_NS) + column
+
+def csv_engine():
+    engine = os.getenv('DWCA_CSV_ENGINE', 'arrow')
+    if engine == 'arrow':
+        try:
+            import pyarrow.csv
+        except ImportError:
+            log.debug('pyarrow is not installed, writing the CSVs with pandas')
+            engine = 'pandas'
+    return engine
+
+def csv_safe(df):
+    '''
+    Arrow writes floats in its own format, give it the text pandas writes
+    (and one type per column, see store_helper.arrow_safe).
+    '''
+    df = df.copy()
+    for col in df.columns[df.dtypes == 'float64']:
+        df[col] = df[col].astype(str).where(df[col].notna())
+    return store_helper.arrow_safe(df)
+
+def write_csv(df, f, header=True):
+    '''
+    Write df as CSV to the binary file object f
+    '''
+    if csv_engine() == 'arrow':
+        import pyarrow as pa
+        import pyarrow.csv
+        table = pa.Table.from_pandas(csv_safe(df), preserve_index=False)
+        options = pyarrow.csv.WriteOptions(include_header=header, quoting_style='needed')
+        pyarrow.csv.write_csv(table, f, options)
+        return
+
+    chunk_rows = int(os.getenv('DWCA_CSV_CHUNK_ROWS', 100000))
+    text = io.TextIOWrapper(f, encoding='UTF-8', newline='', write_through=True)
+    try:
+        if df.empty:
+            df.to_csv(text, index=False, header=header)
+        for start in range(0, len(df), chunk_rows):
+            df.iloc[start:start + chunk_rows].to_csv(text, index=False, header=header and start == 0)
+    finally:
+        text.detach()
+
+def write_csv_file(df, path, header=True, append=False):
+    with open(path, 'ab' if append else 'wb') as f:
+        write_csv(df, f, header=header)
+
+def read_columns(table):
+    '''
+    The columns of a table, a dataframe or the header of a CSV file
+    '''
+    if isinstance(table, pd.DataFrame):
+        return list(table.columns)
+    try:
+        return list(pd.read_csv(table, nrows=0).columns)
+    except pd.errors.EmptyDataError:
+        return []
+
+def meta_xml(columns):
+    '''
+    meta.xml describing the files of the archive, columns is {table: [column]}
+    '''
+    lines = ['<?xml version="1.0" encoding="UTF-8"?>',
+             '<archive xmlns="http://rs.tdwg.org/dwc/text/" metadata="eml.xml">']
+    for table, table_columns in columns.items():
+        file_name, row_type = ARCHIVE_TABLES[table]
+        tag = 'core' if table == 'event' else 'extension'
+        lines.append(f'  <{tag} encoding="UTF-8" fieldsTerminatedBy="," linesTerminatedBy="\\n" '
+                     f'fieldsEnclosedBy="&quot;" ignoreHeaderLines="1" rowType={quoteattr(row_type)}>')
+        lines.append(f'    <files><location>{escape(file_name)}</location></files>')
+        id_index = table_columns.index(CORE_ID) if CORE_ID in table_columns else 0
+        lines.append(f'    <{"id" if tag == "core" else "coreid"} index="{id_index}"/>')
+        for index, column in enumerate(table_columns):
+            lines.append(f'    <field index="{index}" term={quoteattr(term_uri(column))}/>')
+        lines.append(f'  </{tag}>')
+    lines.append('</archive>')
+    return '\n'.join(lines) + '\n'
+
+def eml_xml(title, package_id):
+    '''
+    Minimal EML, to be completed with the dataset metadata in the IPT
+    '''
+    today = datetime.date.today().isoformat()
+    return f'''<?xml version="1.0" encoding="UTF-8"?>
+<eml:eml xmlns:eml="eml://ecoinformatics.org/eml-2.1.1" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance"
+         xsi:schemaLocation="eml://ecoinformatics.org/eml-2.1.1 http://rs.gbif.org/schema/eml-gbif-profile/1.1/eml.xsd"
+         packageId={quoteattr(package_id)} system="http://gbif.org" scope="system" xml:lang="eng">
+  <dataset>
+    <title xml:lang="eng">{escape(title)}</title>
+    <creator><organizationName>SeaDataNet</organizationName></creator>
+    <metadataProvider><organizationName>SeaDataNet</organizationName></metadataProvider>
+    <pubDate>{today}</pubDate>
+    <language>eng</language>
+    <abstract><para>{escape(title)}, converted from a SeaDataNet CDI order.</para></abstract>
+    <contact><organizationName>SeaDataNet</organizationName></contact>
+  </dataset>
+</eml:eml>
+'''
+
+def write_archive(path, tables, title, package_id):
+    '''
+    Write the archive to path, tables is {table: dataframe or csv path} for
+    the tables in ARCHIVE_TABLES. Written to a temp file that replaces the
+    archive when it's complete.
+    '''
+    tmp_path = f'{path}.tmp'
+    columns = {}
+    # The fastest deflate level, the EMOF tables compress well anyway
+    compresslevel = int(os.getenv('DWCA_COMPRESSLEVEL', 1))
+    with zipfile.ZipFile(tmp_path, 'w', zipfile.ZIP_DEFLATED, compresslevel=compresslevel) as zip_ref:
+        for table, data in tables.items():
+            file_name = ARCHIVE_TABLES[table][0]
+            columns[table] = read_columns(data)
+            with zip_ref.open(file_name, 'w', force_zip64=True) as f:
+                if isinstance(data, pd.DataFrame):
+                    write_csv(data, f)
+                else:
+                    with open(data, 'rb') as src:
+                        shutil.copyfileobj(src, f, 1024 * 1024)
+        zip_ref.writestr('meta.xml', meta_xml(columns))
+        zip_ref.writestr('eml.xml', eml_xml(title, package_id))
+    os.replace(tmp_path, path)
+    log.debug(f'   -Wrote archive {path}')
@@ -0,0 +1,93 @@
+'''
+Runs the phases of the trigger jobs concurrently. The cheap phases (checking
+for new data, polling and placing orders) only wait on the Seadatanet API and
+run on a pool of JOB_CHECK_WORKERS threads. The heavy phases (downloading the
+order and converting it to DwC) run on a pool of JOB_CONVERT_WORKERS processes
+that lives across check cycles, so a long conversion never holds up the checks
+of the other jobs. A job is locked while its heavy phase runs, it isn't checked
+or started again until it's done.
+'''
+
+import os
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait
+
+log = logging.getLogger('job_executor')
+
+
+class JobExecutor:
+    def __init__(self, check_workers=None, convert_workers=None):
+        if check_workers is None:
+            check_workers = int(os.getenv('JOB_CHECK_WORKERS', 8))
+        if convert_workers is None:
+            convert_workers = int(os.getenv('JOB_CONVERT_WORKERS', 2))
+        self.check_pool = ThreadPoolExecutor(max_workers=check_workers, thread_name_prefix='job-check')
+        self.convert_pool = ProcessPoolExecutor(max_workers=convert_workers)
+        self.lock = threading.Lock()
+        self.running = {}
+
+    def running_jobs(self):
+        '''
+        The ids of the jobs with a heavy phase running. A job is only unlocked
+        after its result is written, so jobs that aren't in here can be read
+        from the DB safely.
+        '''
+        with self.lock:
+            return set(self.running)
+
+    def map_checks(self, func, job_dicts):
+        '''
+        Run func(job_dict) for all the jobs on the thread pool and return the
+        results in the order of job_dicts. A job that fails gives None, the
+        error is logged and doesn't affect the other jobs.
+        '''
+        futures = [self.check_pool.submit(func, job_dict) for job_dict in job_dicts]
+        results = []
+        for job_dict, future in zip(job_dicts, futures):
+            try:
+                results.append(future.result())
+            except Exception as e:
+                log.error('Job Error for job {0}: {1}'.format(job_dict.get('job_id'), e))
+                results.append(None)
+        return results
+
+    def submit_heavy(self, job_id, func, *args, callback=None):
+        '''
+        Run func(*args) for a job on the process pool, unless the job already
+        has a heavy phase running. callback(result) is called with the result
+        when it's done. Returns the future, or None if the job is locked.
+        '''
+        with self.lock:
+            if job_id in self.running:
+                log.info('Job {0} is still running, not starting it again'.format(job_id))
+                return None
+            future = self.convert_pool.submit(func, *args)
+            self.running[job_id] = future
+        log.debug('Started heavy phase of job {0}'.format(job_id))
+
+        def done(future):
+            try:
+                result = future.result()
+                if callback is not None:
+                    callback(result)
+            except Exception as e:
+                log.error('Job Error for job {0}: {1}'.format(job_id, e))
+            finally:
+                with self.lock:
+                    self.running.pop(job_id, None)
+
+        future.add_done_callback(done)
+        return future
+
+    def wait_heavy(self):
+        '''
+        Wait until all the running heavy phases are done
+        '''
+        with self.lock:
+            futures = list(self.running.values())
+        wait(futures)
+
+    def shutdown(self, wait=True):
+        self.check_pool.shutdown(wait=wait)
+        self.convert_pool.shutdown(wait=wait)
@@ -0,0 +1,141 @@
+'''
+Typed model of a row of the jobs table. Columns are matched by name (not by
+position) and converted once when the row is read: last_run becomes a datetime
+and query a dict. A Job remembers which fields were changed, so only those
+columns are written back.
+
+Jobs still behave like the old job dicts (job.get('name'), job['order_placed']
+= 0) so the trigger functions can use either.
+'''
+
+import json
+import datetime
+import logging
+
+log = logging.getLogger('job_model')
+
+# Job field -> jobs table column
+FIELD_COLUMNS = {'job_id': 'id',
+                 'name': 'name',
+                 'active': 'active',
+                 'order_placed': 'order_placed',
+                 'retrigger': 'retrigger',
+                 'query': 'query',
+                 'last_run': 'last_run',
+                 'last_data_file': 'last_data_file',
+                 'last_meta_file': 'last_meta_file',
+                 'order_id': 'order_id',
+                 'owner': 'owner',
+                 'owner_email': 'owner_email',
+                 'check_interval': 'check_interval'}
+COLUMN_FIELDS = {column: field for field, column in FIELD_COLUMNS.items()}
+
+NEVER_RUN = datetime.datetime(1900, 1, 1)
+DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+
+
+def parse_datetime(value):
+    '''
+    Read a last_run value, a job that has never run gets 1900-01-01
+    '''
+    if value is None or value == '':
+        return NEVER_RUN
+    if isinstance(value, datetime.datetime):
+        return value
+    for fmt in (DATETIME_FORMAT, '%Y-%m-%d %H:%M:%S'):
+        try:
+            return datetime.datetime.strptime(value, fmt)
+        except ValueError:
+            pass
+    try:
+        return datetime.datetime.fromisoformat(value)
+    except ValueError:
+        log.warning(f'Could not parse last_run {value!r}')
+        return NEVER_RUN
+
+def format_datetime(value):
+    '''
+    Store datetimes with microseconds, always in the same format
+    (str() drops them when they're 0)
+    '''
+    return value.strftime(DATETIME_FORMAT)
+
+def parse_query(value):
+    if value is None or isinstance(value, dict):
+        return value
+    return json.loads(value)
+
+# Conversions from the stored values, per field
+CONVERTERS = {'last_run': parse_datetime,
+              'query': parse_query}
+
+# Marks the fields of a Job that aren't set yet
+_MISSING = object()
+
+
+class Job:
+    __slots__ = tuple(FIELD_COLUMNS) + ('_dirty',)
+
+    def __init__(self, **fields):
+        for field in FIELD_COLUMNS:
+            value = fields.pop(field, None)
+            converter = CONVERTERS.get(field)
+            setattr(self, field, converter(value) if converter else value)
+        if fields:
+            raise TypeError(f'Unknown job fields: {sorted(fields)}')
+        self._dirty = set()
+
+    @classmethod
+    def row_factory(cls, cursor, row):
+        '''
+        sqlite3 row factory that turns rows of the jobs table into Jobs,
+        columns unknown to the model are ignored.
+        '''
+        fields = {}
+        for description, value in zip(cursor.description, row):
+            field = COLUMN_FIELDS.get(description[0])
+            if field is not None:
+                fields[field] = value
+        return cls(**fields)
+
+    def __setattr__(self, field, value):
+        # Writing back the same value doesn't make the field dirty
+        changed = getattr(self, field, _MISSING) != value
+        object.__setattr__(self, field, value)
+        if changed and field != '_dirty' and hasattr(self, '_dirty'):
+            self._dirty.add(field)
+
+    def __getitem__(self, field):
+        if field not in FIELD_COLUMNS:
+            raise KeyError(field)
+        return getattr(self, field)
+
+    def __setitem__(self, field, value):
+        if field not in FIELD_COLUMNS:
+            raise KeyError(field)
+        setattr(self, field, value)
+
+    def get(self, field, default=None):
+        if field not in FIELD_COLUMNS:
+            return default
+        return getattr(self, field)
+
+    def __repr__(self):
+        return f'Job({self.job_id}, {self.name!r})'
+
+    @property
+    def dirty(self):
+        return frozenset(self._dirty)
+
+    def changes(self):
+        '''
+        The changed fields as {column: value}, datetimes and dicts are
+        converted by the sqlite adapters (see db_helper).
+        '''
+        return {FIELD_COLUMNS[field]: getattr(self, field) for field in sorted(self._dirty)}
+
+    def mark_clean(self):
+        self._dirty = set()
+
+    def to_dict(self):
+        return {field: getattr(self, field) for field in FIELD_COLUMNS}
@@ -0,0 +1,146 @@
+'''
+Content-addressed manifest for incremental conversions. It lives in the
+job folder, next to the folders of the orders, so it outlives a single
+order:
+
+> /code/datasets/<order name>/_manifest/manifest.json
+> /code/datasets/<order name>/_manifest/fragments/<key>/event.parquet
+> /code/datasets/<order name>/_manifest/fragments/<key>/occ.parquet
+> /code/datasets/<order name>/_manifest/fragments/<key>/emof.parquet
+
+The manifest records, per ODV member of the last converted order, the
+SHA-1 of its content, the LOCAL_CDI_IDs it refers to and the key of its
+fragment. The key is a hash of the member content and of the metadata rows
+of those LOCAL_CDI_IDs, so a member only has to be converted again if
+either of them changed (or MANIFEST_VERSION is bumped).
+'''
+
+import os
+import json
+import shutil
+import hashlib
+import logging
+import pathlib
+
+import pandas as pd
+
+import app.store_helper as store_helper
+
+log = logging.getLogger('manifest_helper')
+
+# Bump when the conversion changes in a way that invalidates the fragments
+MANIFEST_VERSION = 2
+
+FRAGMENT_TABLES = ['event', 'occ', 'emof']
+
+
+def manifest_folder(folder_dict):
+    '''
+    The manifest is kept in the job folder, the parent of the order folder
+    '''
+    return pathlib.Path(folder_dict.get('odv_zip')).parent.parent.joinpath('_manifest')
+
+def manifest_path(folder_dict):
+    return manifest_folder(folder_dict).joinpath('manifest.json')
+
+def fragment_path(folder_dict, key):
+    return manifest_folder(folder_dict).joinpath('fragments', key)
+
+def read_manifest(folder_dict):
+    '''
+    Read the manifest of the previous conversion, an empty one if there is
+    none or it was written by another version.
+    '''
+    try:
+        with open(manifest_path(folder_dict)) as f:
+            manifest = json.load(f)
+        if manifest.get('version') == MANIFEST_VERSION:
+            return manifest
+        log.info('   -Manifest from another version, converting everything again...')
+    except (OSError, ValueError):
+        pass
+    return {'version': MANIFEST_VERSION, 'members': {}}
+
+def write_manifest(manifest, folder_dict):
+    '''
+    Replace the manifest, through a temp file so a crash never leaves half of it
+    '''
+    path = manifest_path(folder_dict)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_suffix('.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, path)
+
+def member_hash(zip_ref, member):
+    '''
+    SHA-1 of the content of a zip member, read in blocks
+    '''
+    sha1 = hashlib.sha1()
+    with zip_ref.open(member) as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+def metadata_hashes(metadata_df):
+    '''
+    SHA-1 of the metadata row(s) of every LOCAL_CDI_ID, as {LOCAL_CDI_ID: hash}.
+    metadata_df is indexed on the LOCAL_CDI_ID key (see odv_to_dwc.load_metadata),
+    which is hashed as the last column.
+    '''
+    if metadata_df.empty:
+        return {}
+    keys = metadata_df.index.to_numpy()
+    row_text = metadata_df.assign(key=keys).astype(str).agg('\x1f'.join, axis=1)
+    hashes = {}
+    for cdi_id, rows in row_text.groupby(keys, sort=False):
+        hashes[cdi_id] = hashlib.sha1('\x1e'.join(rows).encode('UTF-8')).hexdigest()
+    return hashes
+
+def fragment_key(member_hash, cdi_ids, meta_hashes):
+    '''
+    Key of the fragment of a member, from its content and metadata
+    '''
+    meta = ','.join(f'{x}={meta_hashes.get(x)}' for x in sorted(cdi_ids))
+    return hashlib.sha1(f'{MANIFEST_VERSION}:{member_hash}:{meta}'.encode('UTF-8')).hexdigest()
+
+def has_fragment(folder_dict, key):
+    return fragment_path(folder_dict, key).is_dir()
+
+def write_fragment(folder_dict, key, tables):
+    '''
+    Write the event/occ/emof tables of a member. The fragment is written in a
+    temp folder that is renamed when complete.
+    '''
+    path = fragment_path(folder_dict, key)
+    tmp_path = path.with_name(key + '.tmp')
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    tmp_path.mkdir(parents=True)
+    for name, df in tables.items():
+        if not df.empty:
+            store_helper.arrow_safe(df.copy()).to_parquet(tmp_path.joinpath(f'{name}.parquet'), index=False)
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(tmp_path, path)
+
+def read_fragment(folder_dict, key):
+    '''
+    Read the tables of a fragment, {table name: dataframe}
+    '''
+    path = fragment_path(folder_dict, key)
+    tables = {}
+    for name in FRAGMENT_TABLES:
+        table_path = path.joinpath(f'{name}.parquet')
+        tables[name] = pd.read_parquet(table_path) if table_path.exists() else pd.DataFrame()
+    return tables
+
+def prune_fragments(manifest, folder_dict):
+    '''
+    Remove the fragments the manifest doesn't refer to anymore
+    '''
+    keep = set(x['key'] for x in manifest['members'].values())
+    fragments = manifest_folder(folder_dict).joinpath('fragments')
+    if not fragments.is_dir():
+        return
+    for path in fragments.iterdir():
+        if path.name not in keep:
+            shutil.rmtree(path, ignore_errors=True)
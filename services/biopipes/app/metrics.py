@@ -0,0 +1,64 @@
+'''
+Prometheus metrics of the trigger service, served on METRICS_PORT when it's
+set. The stage reports of the conversions (see stage_metrics) are added to:
+
+- biopipes_stage_seconds (histogram, per stage): wall time of every stage
+- biopipes_stage_cpu_seconds_total (counter, per stage)
+- biopipes_stage_rows_total (counter, per stage and direction in/out)
+- biopipes_stage_peak_rss_bytes (gauge, per stage): of the last conversion
+- biopipes_conversions_total (counter, per mode)
+
+prometheus_client is optional, without it nothing is collected.
+'''
+
+import os
+import logging
+
+try:
+    import prometheus_client
+except ImportError:
+    prometheus_client = None
+
+log = logging.getLogger('metrics')
+
+# Conversions take anything from a second to hours
+SECONDS_BUCKETS = (0.1, 0.5, 1, 5, 15, 60, 300, 900, 3600, 4 * 3600, float('inf'))
+
+if prometheus_client is not None:
+    STAGE_SECONDS = prometheus_client.Histogram('biopipes_stage_seconds', 'Wall time of the conversion stages',
+                                                ['stage'], buckets=SECONDS_BUCKETS)
+    STAGE_CPU_SECONDS = prometheus_client.Counter('biopipes_stage_cpu_seconds', 'CPU time of the conversion stages',
+                                                  ['stage'])
+    STAGE_ROWS = prometheus_client.Counter('biopipes_stage_rows', 'Rows going in/out of the conversion stages',
+                                           ['stage', 'direction'])
+    STAGE_PEAK_RSS = prometheus_client.Gauge('biopipes_stage_peak_rss_bytes',
+                                             'Peak RSS during the stage, of the last conversion', ['stage'])
+    CONVERSIONS = prometheus_client.Counter('biopipes_conversions', 'ODV to DwC conversions', ['mode'])
+
+
+def start_server():
+    '''
+    Serve the metrics on METRICS_PORT, if it's set
+    '''
+    port = os.getenv('METRICS_PORT')
+    if not port:
+        return
+    if prometheus_client is None:
+        log.warning('METRICS_PORT is set but prometheus_client is not installed, no metrics are served')
+        return
+    prometheus_client.start_http_server(int(port))
+    log.info(f'Serving metrics on port {port}')
+
+def observe_report(report):
+    '''
+    Add the stage report of a conversion to the metrics
+    '''
+    if prometheus_client is None or report is None:
+        return
+    CONVERSIONS.labels(report.get('mode')).inc()
+    for stage, values in report.get('stages', {}).items():
+        STAGE_SECONDS.labels(stage).observe(values['wall'])
+        STAGE_CPU_SECONDS.labels(stage).inc(values['cpu'])
+        STAGE_ROWS.labels(stage, 'in').inc(values['rows_in'])
+        STAGE_ROWS.labels(stage, 'out').inc(values['rows_out'])
+        STAGE_PEAK_RSS.labels(stage).set(values['peak_rss_mb'] * 2 ** 20)
@@ -2,26 +2,36 @@
 import zipfile
 import pathlib
 import os
+import io
 import re
 import hashlib
+import shutil
+import tempfile
 
 # NonStd
 import numpy as np
 import pandas as pd
-import geopy.distance
 import itertools
-import requests
-import json
 import logging
-import uuid
 from functools import cache
 from itertools import chain
+from collections import namedtuple, deque
+from concurrent.futures import ProcessPoolExecutor
 
 # Custom
 import pyodv
+import app.vocab_helper as vocab_helper
+import app.store_helper as store_helper
+import app.manifest_helper as manifest_helper
+import app.stage_metrics as stage_metrics
+import app.dwca_helper as dwca_helper
 
 log = logging.getLogger('odv_to_dwc')
 
+# The parts of a parsed ODV file needed after parsing, lighter to pass
+# around (and between processes) than the pyodv.ODV_Struct
+ODVHeader = namedtuple('ODVHeader', ['file_path', 'refs', 'params'])
+
 
 # Below are the dictionaries that map the ODV terms to the DwC terms.
 # The columns in the value list are matched by order. Example:
@@ -83,10 +93,60 @@ meta_event_mapping = {
         'locationRemarks':[None],
         }
 
-def odv_to_dwc(job_dict):
+emof_columns = ['eventID',
+                'occurrenceID',
+                'measurementID',
+                'measurementValue',
+                'measurementValueID',
+                'measurementType',
+                'measurementTypeID',
+                'measurementUnit',
+                'measurementUnitID']
+
+# Types of the text columns of the CDI metadata csv, the ones that repeat a
+# handful of values are categories
+META_DTYPES = {'LOCAL_CDI_ID': 'object',
+               'EDMED references': 'category',
+               'Station name': 'object',
+               'Alternative station name': 'object',
+               'Instrument / gear type': 'category',
+               'Platform type': 'category',
+               'Depth reference': 'category'}
+META_KEY = 'LOCAL_CDI_ID_split'
+
+# Columns of the bounding box of a CDI, from the metadata
+BOX_COLUMNS = ['Latitude 1', 'Latitude 2', 'Longitude 1', 'Longitude 2']
+
+# Columns the eventID is made of, in this order
+EVENT_ID_COLUMNS = ['LOCAL_CDI_ID',
+                    'Station',
+                    'yyyy-mm-ddThh:mm:ss.sss',
+                    'YYYY-MM-DDThh:mm:ss.sss',
+                    'Samplingprotocol',
+                    'SamplingProtocol',
+                    'maximumDepthInMeters',
+                    'MaximumObservationDepth',
+                    'minimumDepthInMeters',
+                    'MinimumObservationDepth']
+
+# The metadata columns joined onto the ODV rows: the ones the mappings, the
+# WKT, the IDs and create_new_columns read. The others are only used by the
+# metadata events/EMOF, which read the metadata itself. The ODV rows have
+# their own LOCAL_CDI_ID, the key.
+META_JOIN_COLUMNS = sorted(({x for mapping in (event_mapping, occ_mapping) for sources in mapping.values()
+                             for x in sources if x is not None}
+                            | set(BOX_COLUMNS) | set(EVENT_ID_COLUMNS) | {'Station name', 'Alternative station name'})
+                           - {'LOCAL_CDI_ID'})
+
+# Text columns with at most this many distinct values per row become categoricals
+CATEGORY_RATIO = 0.5
+
+def odv_to_dwc(job_dict, reprocess=False):
     '''
     The actual function that does the conversions from
-    the ODV zip into the DwC
+    the ODV zip into the DwC. With reprocess the merged dataset is
+    read back from the parquet store of an earlier run (if it's there
+    and up to date) instead of parsing the ODV zip again.
     '''
     odv_zip = job_dict.get('last_data_file')
     odv_meta = job_dict.get('last_data_file')
@@ -96,25 +156,44 @@ def odv_to_dwc(job_dict):
 
     log.info(f'===Converting {odv_zip} to DwC===')
     folder_dict = create_folder_structure(odv_zip)
-    unzip(folder_dict)
-    parsed_df, odv_list = parse_odv(folder_dict)
+    mode = os.getenv('CONVERSION_MODE', 'full')
+    parsed_df = None
+    # Every conversion leaves a stage report in the dwc folder
+    with stage_metrics.recording(folder_dict.get('stage_report_path'), job_id=job_dict.get('job_id'),
+                                 odv_zip=str(odv_zip), mode=mode, reprocess=reprocess), \
+            stage_metrics.profiling(job_dict.get('job_id'), folder_dict.get('dwc_path')):
+        if mode == 'incremental':
+            # The fragments of the manifest take the place of the parquet store
+            odv_to_dwc_incremental(folder_dict)
+        elif mode == 'streaming':
+            odv_to_dwc_streaming(folder_dict, reprocess and use_store(folder_dict))
+        else:
+            parsed_df = odv_to_dwc_full(folder_dict, reprocess and use_store(folder_dict))
 
-    # Create new IDs
-    # ==================
-    log.debug('   -Building WKT...')
-    applied_df = parsed_df.apply(lambda row: create_wkt(row), axis='columns', result_type='expand')
-    applied_df = applied_df.rename(columns={0: 'CoordinateUncertaintyInMeters', 1: 'footprint_wkt'})
-    parsed_df  = pd.concat([parsed_df, applied_df], axis='columns')
-    parsed_df = rename_odv_columns(parsed_df)
-    parsed_df = create_new_columns(parsed_df)
-    log.debug('   -Creating Event and Occurrence IDs...')
-    df_id = parsed_df.apply(lambda row: create_IDs(row), axis='columns', result_type='expand')
-    df_id = df_id.rename(columns={0: 'eventID', 1: 'occurrenceID', 2: 'parentEventID'})
-    parsed_df  = pd.concat([parsed_df, df_id], axis='columns')
+    log.info(f'===Finished converting {odv_zip} to DwC===')
+    return parsed_df
+
+def odv_to_dwc_full(folder_dict, reprocess=False):
+    '''
+    Convert the whole order in memory, returns the merged dataset
+    '''
+    metadata_df = load_metadata(folder_dict)
+    if reprocess:
+        with stage_metrics.stage('read_store') as rows:
+            parsed_df, headers = store_helper.read_store(folder_dict)
+            rows['rows_out'] = len(parsed_df)
+        odv_list = [ODVHeader(**x) for x in headers]
+    else:
+        parsed_df, odv_list = parse_odv(folder_dict, index_metadata(metadata_df))
+    parsed_df = compact_dtypes(parsed_df)
+    if not reprocess:
+        with stage_metrics.stage('write_store', len(parsed_df)):
+            store_helper.write_store(parsed_df, odv_list, folder_dict)
+    parsed_df = annotate_odv(parsed_df)
 
     # Create EventCore File
     dwc_event = odv_dwc_mapping(parsed_df, event_mapping)
-    dwc_meta_event = meta_event_gen(folder_dict)
+    dwc_meta_event = meta_event_gen(folder_dict, metadata_df)
     dwc_event = pd.concat([dwc_meta_event,dwc_event])
 
     # Create EMOF from Occ data
@@ -122,7 +201,7 @@ def odv_to_dwc(job_dict):
     event_dwc_emof = emof_gen(parsed_df, params)
 
     # Create EMOF from Event data
-    meta_dwc_emof = meta_emof_gen(folder_dict)
+    meta_dwc_emof = meta_emof_gen(folder_dict, metadata_df)
     dwc_emof = pd.concat([meta_dwc_emof,event_dwc_emof])
     dwc_emof = emof_cleanup(dwc_emof, occ_mapping, event_mapping)
 
@@ -142,15 +221,383 @@ def odv_to_dwc(job_dict):
         log.warning('Possible issues with duplicate Occurrence IDs')
 
     # Write files:
-    dwc_event.to_csv(folder_dict.get('event_path'), index = False)
-    dwc_occ.to_csv(folder_dict.get('occ_path'), index = False)
-    dwc_emof.to_csv(folder_dict.get('emof_path'), index = False)
-    parsed_df.to_csv(folder_dict.get('all_data_path'), index = False)
+    write_outputs(folder_dict, dwc_event, dwc_occ, dwc_emof)
+    if os.getenv('WRITE_ALL_CSV', '0') == '1':
+        write_csv(parsed_df, folder_dict.get('all_data_path'))
 
-    log.info(f'===Finished converting {odv_zip} to DwC===')
     return parsed_df
 
 
+def use_store(folder_dict):
+    '''
+    Check if a reprocess can start from the parquet store
+    '''
+    if store_helper.store_is_valid(folder_dict):
+        log.info(f"   -Reprocessing from parquet store {store_helper.store_path(folder_dict)}...")
+        return True
+    log.info('   -No up to date parquet store, parsing the ODV zip...')
+    return False
+
+def odv_to_dwc_streaming(folder_dict, reprocess=False):
+    '''
+    Streaming version of the conversion, used when CONVERSION_MODE=streaming.
+    The order is converted in chunks of whole ODV files of about ODV_CHUNK_ROWS
+    rows, and each chunk is appended to the event/occurrence/EMOF files so only
+    one chunk is in memory at a time. Rows are deduplicated over the whole order
+    with sets of 64 bit row hashes instead of drop_duplicates on the full tables.
+
+    The occurrence and EMOF columns are fixed up front, all.csv isn't written
+    in this mode. The event rows are spooled to disk and only written at the
+    end, with the columns and types of the full conversion (see
+    write_spooled_events). The chunks are written to the parquet store as they
+    go, or read from it with reprocess.
+    '''
+    chunk_rows = int(os.getenv('ODV_CHUNK_ROWS', 200000))
+    log.info(f'   -Streaming conversion in chunks of {chunk_rows} rows...')
+    metadata_df = load_metadata(folder_dict)
+    if reprocess:
+        chunks = ((chunk_df, [ODVHeader(**x) for x in headers])
+                  for chunk_df, headers in store_helper.iter_store_chunks(folder_dict, chunk_rows))
+    else:
+        store_helper.clear_store(folder_dict)
+        chunks = iter_odv_chunks(folder_dict, index_metadata(metadata_df), chunk_rows)
+    all_headers = []
+    seen = {'event': set(), 'occ': set(), 'emof': set(), 'eventID': set(), 'occurrenceID': set()}
+    dup_event_ids = 0
+    dup_occ_ids = 0
+
+    # The metadata parts go first, like in the full conversion
+    event_spool = []
+    spool_dir = tempfile.mkdtemp(prefix='event_spool_', dir=folder_dict.get('dwc_path'))
+    dwc_meta_event = meta_event_gen(folder_dict, metadata_df)
+    occ_columns = mapped_columns(occ_mapping)
+
+    dwc_meta_event = drop_seen(dwc_meta_event, seen['event'])
+    dup_event_ids += count_seen(dwc_meta_event['eventID'], seen['eventID'])
+    spool_events(dwc_meta_event, spool_dir, event_spool)
+    append_csv(pd.DataFrame(), folder_dict.get('occ_path'), occ_columns, first=True)
+    meta_dwc_emof = emof_cleanup(meta_emof_gen(folder_dict, metadata_df), occ_mapping, event_mapping)
+    append_csv(meta_dwc_emof, folder_dict.get('emof_path'), emof_columns, first=True)
+
+    for n, (chunk_df, odv_list) in enumerate(stage_metrics.timed_iter('read_store' if reprocess else 'parse_odv', chunks)):
+        log.debug(f'   -Chunk {n}: {len(chunk_df)} rows from {len(odv_list)} files')
+        if not reprocess:
+            store_helper.write_store_chunk(chunk_df, folder_dict, n)
+            all_headers += odv_list
+        chunk_df = annotate_odv(compact_dtypes(chunk_df))
+
+        dwc_event = drop_seen(odv_dwc_mapping(chunk_df, event_mapping), seen['event'])
+        dup_event_ids += count_seen(dwc_event['eventID'], seen['eventID'])
+        spool_events(dwc_event, spool_dir, event_spool)
+
+        dwc_occ = drop_seen(odv_dwc_mapping(chunk_df, occ_mapping), seen['occ'])
+        dup_occ_ids += count_seen(dwc_occ['occurrenceID'], seen['occurrenceID'])
+        append_csv(dwc_occ, folder_dict.get('occ_path'), occ_columns)
+
+        params = convert_params_to_df(odv_list)
+        dwc_emof = emof_cleanup(emof_gen(chunk_df, params), occ_mapping, event_mapping)
+        # Only the instrument records (without measurementID) can repeat between chunks
+        tool_rows = dwc_emof['measurementID'].isna()
+        dwc_emof = pd.concat([dwc_emof[~tool_rows], drop_seen(dwc_emof[tool_rows], seen['emof'])])
+        append_csv(dwc_emof, folder_dict.get('emof_path'), emof_columns)
+
+    if not reprocess:
+        store_helper.write_store_headers(all_headers, folder_dict)
+    try:
+        write_spooled_events(event_spool, folder_dict.get('event_path'))
+    finally:
+        shutil.rmtree(spool_dir, ignore_errors=True)
+
+    # The chunks can only be appended to files, the archive is packed from them
+    if dwc_output() != 'csv':
+        write_dwca(folder_dict, {name: folder_dict.get(f'{name}_path') for name in dwca_helper.ARCHIVE_TABLES})
+    if dwc_output() == 'archive':
+        remove_csvs(folder_dict)
+
+    if dup_event_ids > 0:
+        log.warning('Possible issues with duplicate event_ids')
+    if dup_occ_ids > 0:
+        log.warning('Possible issues with duplicate Occurrence IDs')
+
+def odv_to_dwc_incremental(folder_dict):
+    '''
+    Incremental version of the conversion, used when CONVERSION_MODE=incremental.
+    The event/occurrence/EMOF rows of every ODV member are kept as a fragment in
+    the job manifest (see manifest_helper). Only the members whose content or
+    metadata rows changed since the last order are parsed and converted, the
+    fragments of the others are reused, and the output files are assembled from
+    all the fragments. The metadata parts are always converted again.
+    '''
+    odv_zip = folder_dict.get('odv_zip')
+    old_manifest = manifest_helper.read_manifest(folder_dict)
+    by_content = {x['content']: x for x in old_manifest['members'].values()}
+    metadata_df = load_metadata(folder_dict)
+    meta_hashes = manifest_helper.metadata_hashes(metadata_df)
+    meta_index = index_metadata(metadata_df)
+
+    members = list_odv_members(folder_dict)
+    manifest = {'version': manifest_helper.MANIFEST_VERSION, 'members': {}}
+    member_hashes = {}
+    with zipfile.ZipFile(odv_zip, 'r') as zip_ref:
+        for member in members:
+            member_hashes[member] = manifest_helper.member_hash(zip_ref, member)
+            old = by_content.get(member_hashes[member])
+            if old is None:
+                continue
+            key = manifest_helper.fragment_key(member_hashes[member], old['cdi_ids'], meta_hashes)
+            if manifest_helper.has_fragment(folder_dict, key):
+                manifest['members'][member] = {'content': member_hashes[member], 'cdi_ids': old['cdi_ids'], 'key': key}
+    to_convert = [x for x in members if x not in manifest['members']]
+    log.info(f'   -Incremental conversion: {len(members) - len(to_convert)} files unchanged, {len(to_convert)} to convert...')
+
+    for member, result in zip(to_convert, stage_metrics.timed_iter('parse_odv', iter_odv_files(odv_zip, to_convert))):
+        if result is None:
+            # Not an ODV file, keep an empty fragment so it isn't parsed again
+            cdi_ids, tables = [], {}
+        else:
+            this_df, odv_header = result
+            cdi_ids = sorted(set(this_df['LOCAL_CDI_ID'].dropna().astype(str))) if 'LOCAL_CDI_ID' in this_df.columns else []
+            tables = convert_member(join_metadata(this_df, meta_index), odv_header)
+        key = manifest_helper.fragment_key(member_hashes[member], cdi_ids, meta_hashes)
+        manifest_helper.write_fragment(folder_dict, key, tables)
+        manifest['members'][member] = {'content': member_hashes[member], 'cdi_ids': cdi_ids, 'key': key}
+
+    # Assemble the output files from the fragments, in the order of the members
+    log.debug(f'   -Assembling {len(members)} fragments...')
+    fragments = {name: [] for name in manifest_helper.FRAGMENT_TABLES}
+    for member in members:
+        for name, df in manifest_helper.read_fragment(folder_dict, manifest['members'][member]['key']).items():
+            if not df.empty:
+                fragments[name].append(df)
+
+    dwc_event = pd.concat([meta_event_gen(folder_dict, metadata_df), concat_fragments(fragments['event']).drop_duplicates()])
+    dwc_occ = concat_fragments(fragments['occ']).drop_duplicates()
+    dwc_emof = concat_fragments(fragments['emof'])
+    if not dwc_emof.empty:
+        # The instrument records of an event can come from more than one file
+        tool_rows = dwc_emof['measurementID'].isna()
+        dwc_emof = pd.concat([dwc_emof[~tool_rows], dwc_emof[tool_rows].drop_duplicates()])
+    meta_dwc_emof = emof_cleanup(meta_emof_gen(folder_dict, metadata_df), occ_mapping, event_mapping)
+    dwc_emof = pd.concat([meta_dwc_emof, dwc_emof], ignore_index=True)
+
+    if not check_IDs(dwc_event, ['eventID']):
+        log.warning('Possible issues with duplicate event_ids')
+    if not dwc_occ.empty and not check_IDs(dwc_occ, ['occurrenceID']):
+        log.warning('Possible issues with duplicate Occurrence IDs')
+
+    write_outputs(folder_dict, dwc_event, dwc_occ, dwc_emof)
+
+    # Only forget the old fragments once the outputs are written
+    manifest_helper.write_manifest(manifest, folder_dict)
+    manifest_helper.prune_fragments(manifest, folder_dict)
+
+def convert_member(merged_df, odv_header):
+    '''
+    Convert the merged data of a single ODV file into its event/occ/emof tables
+    '''
+    merged_df = annotate_odv(merged_df)
+    params = convert_params_to_df([odv_header])
+    return {'event': odv_dwc_mapping(merged_df, event_mapping),
+            'occ': odv_dwc_mapping(merged_df, occ_mapping),
+            'emof': emof_cleanup(emof_gen(merged_df, params), occ_mapping, event_mapping)}
+
+def concat_fragments(df_list):
+    if not df_list:
+        return pd.DataFrame()
+    return pd.concat(df_list, ignore_index=True)
+
+def annotate_odv(parsed_df):
+    '''
+    Add the WKT, DwC helper columns and the event/occurrence IDs to the
+    merged ODV data.
+    '''
+    # Create new IDs
+    # ==================
+    log.debug('   -Building WKT...')
+    applied_df = create_wkt(parsed_df)
+    parsed_df  = pd.concat([parsed_df, applied_df], axis='columns')
+    parsed_df = rename_odv_columns(parsed_df)
+    parsed_df = create_new_columns(parsed_df)
+    # The new columns repeat a few values on every row
+    new_columns = [x for x in NEW_COLUMNS if x in parsed_df.columns]
+    parsed_df[new_columns] = compact_dtypes(parsed_df[new_columns], report=False)
+    log.debug('   -Creating Event and Occurrence IDs...')
+    df_id = compact_dtypes(create_IDs(parsed_df), report=False)
+    parsed_df  = pd.concat([parsed_df, df_id], axis='columns')
+    return parsed_df
+
+@stage_metrics.timed('compact_dtypes')
+def compact_dtypes(df, report=True):
+    '''
+    Store the text columns that repeat their values (at most CATEGORY_RATIO
+    distinct values per row) as categoricals, and the integer columns in the
+    smallest integer type. Floats are left alone, their text would change.
+    Columns holding None are skipped, the IDs tell None and NaN apart.
+    '''
+    if report:
+        before = df.memory_usage(deep=True).sum()
+    compact = {}
+    for col in df.columns[df.dtypes == object]:
+        if isinstance(df[col], pd.DataFrame):
+            # Duplicate column names, coalesced later on
+            continue
+        codes, uniques = pd.factorize(df[col])
+        if len(uniques) > CATEGORY_RATIO * len(df) or pd.api.types.infer_dtype(uniques, skipna=True) != 'string':
+            continue
+        missing = codes == -1
+        if missing.any() and any(x is None for x in df[col].to_numpy()[missing]):
+            continue
+        compact[col] = pd.Categorical.from_codes(codes, categories=uniques)
+    for col in df.columns[[pd.api.types.is_signed_integer_dtype(x) for x in df.dtypes]]:
+        if not isinstance(df[col], pd.DataFrame):
+            compact[col] = pd.to_numeric(df[col], downcast='integer')
+    if compact:
+        df = df.assign(**compact) if df.columns.is_unique else replace_columns(df, compact)
+    if report:
+        after = df.memory_usage(deep=True).sum()
+        log.info(f'   -Compacted {len(compact)} columns: {before / 2 ** 20:.1f} MB -> {after / 2 ** 20:.1f} MB')
+    return df
+
+def replace_columns(df, columns):
+    '''
+    Replace columns by name in a dataframe that has duplicate column names
+    '''
+    df = df.copy(deep=False)
+    positions = {name: i for i, name in reversed(list(enumerate(df.columns)))}
+    for name, values in columns.items():
+        df.isetitem(positions[name], values)
+    return df
+
+def mapped_columns(map_dict):
+    '''
+    The DwC columns a mapping can produce
+    '''
+    return [dwc_colname for dwc_colname, odv_colname_list in map_dict.items() if odv_colname_list != [None]]
+
+def row_hashes(df):
+    '''
+    64 bit hash per row. Integer columns are hashed as floats so the same value
+    hashes the same in a chunk where the column got upcast because of NaNs.
+    '''
+    if isinstance(df, pd.DataFrame):
+        df = df.apply(lambda col: col.astype('float64') if pd.api.types.is_integer_dtype(col) else col)
+    elif pd.api.types.is_integer_dtype(df):
+        df = df.astype('float64')
+    return pd.util.hash_pandas_object(df, index=False).to_numpy()
+
+def drop_seen(df, seen):
+    '''
+    Drop the rows that are duplicated in df or that were already seen in earlier
+    chunks, seen is the set of row hashes that is updated in place.
+    '''
+    if df.empty:
+        return df
+    keys = row_hashes(df)
+    keep = ~pd.Series(keys).duplicated().to_numpy()
+    keep &= np.fromiter((k not in seen for k in keys.tolist()), dtype=bool, count=len(keys))
+    seen.update(keys[keep].tolist())
+    return df[keep]
+
+def count_seen(series, seen):
+    '''
+    Count the values of series that are repeated or were already seen, and
+    add them to the seen set.
+    '''
+    keys = row_hashes(series).tolist()
+    n_seen = 0
+    for k in keys:
+        if k in seen:
+            n_seen += 1
+        else:
+            seen.add(k)
+    return n_seen
+
+def append_csv(df, path, columns, first=False):
+    '''
+    Write df to the csv at path with a fixed set of columns, the first
+    call creates the file and writes the header, the others append.
+    '''
+    df = df.reindex(columns=columns)
+    with stage_metrics.stage(f'write_{pathlib.Path(path).stem}_csv', len(df)) as rows:
+        dwca_helper.write_csv_file(df, path, header=first, append=not first)
+        rows['rows_out'] = len(df)
+
+def spool_events(df, spool_dir, spool):
+    '''
+    Keep the event rows of a chunk on disk until write_spooled_events, spool
+    is the list of (file, empty frame with the columns and types of the rows)
+    '''
+    spool_path = os.path.join(spool_dir, f'{len(spool)}.pkl')
+    df.to_pickle(spool_path)
+    spool.append((spool_path, df.iloc[:0]))
+
+def write_spooled_events(spool, path):
+    '''
+    Write the spooled event rows like the full conversion writes the
+    concatenated event table: with the columns of the metadata events and
+    the mapped columns found in any chunk, in the types the concatenation
+    gives (integer columns that are missing or NaN somewhere become floats).
+    Only one chunk is read back at a time.
+    '''
+    templates = [x for _, x in spool]
+    columns = list(dict.fromkeys(list(templates[0].columns) +
+                                 [x for x in mapped_columns(event_mapping) if any(x in t.columns for t in templates[1:])]))
+    dtypes = pd.concat(templates).dtypes[columns].to_dict()
+    for n, (spool_path, _) in enumerate(spool):
+        df = pd.read_pickle(spool_path).reindex(columns=columns).astype(dtypes)
+        append_csv(df, path, columns, first=n == 0)
+
+def write_csv(df, path):
+    '''
+    Write one of the output files
+    '''
+    with stage_metrics.stage(f'write_{pathlib.Path(path).stem}_csv', len(df)) as rows:
+        dwca_helper.write_csv_file(df, path)
+        rows['rows_out'] = len(df)
+
+def dwc_output():
+    '''
+    DWC_OUTPUT: 'csv' for the loose CSVs, 'archive' for the DwC archive
+    only or 'both'
+    '''
+    return os.getenv('DWC_OUTPUT', 'both')
+
+def write_outputs(folder_dict, dwc_event, dwc_occ, dwc_emof):
+    '''
+    Write the event/occurrence/EMOF tables as CSVs and/or as a DwC archive.
+    With both, the archive is packed from the CSVs, with archive only the
+    tables go straight into the archive.
+    '''
+    tables = {'event': dwc_event, 'occ': dwc_occ, 'emof': dwc_emof}
+    if dwc_output() != 'archive':
+        for name, df in tables.items():
+            write_csv(df, folder_dict.get(f'{name}_path'))
+        tables = {name: folder_dict.get(f'{name}_path') for name in tables}
+    else:
+        remove_csvs(folder_dict)
+    if dwc_output() != 'csv':
+        write_dwca(folder_dict, tables)
+
+def write_dwca(folder_dict, tables):
+    '''
+    Write the DwC archive, named after the order (see create_folder_structure)
+    '''
+    order_path = pathlib.Path(folder_dict.get('odv_zip')).parent
+    title = f'{order_path.parent.name} (SeaDataNet order {order_path.name})'
+    with stage_metrics.stage('write_dwca', sum(len(x) for x in tables.values() if isinstance(x, pd.DataFrame))):
+        dwca_helper.write_archive(folder_dict.get('dwca_path'), tables, title, package_id=order_path.name)
+
+def remove_csvs(folder_dict):
+    '''
+    Remove the CSVs of an earlier conversion, when only the archive is kept
+    '''
+    for name in dwca_helper.ARCHIVE_TABLES:
+        pathlib.Path(folder_dict.get(f'{name}_path')).unlink(missing_ok=True)
+
+# The columns create_new_columns adds
+NEW_COLUMNS = ['occurrenceStatus', 'basisOfRecord', 'institutionCode', 'locality']
+
+@stage_metrics.timed('create_new_columns')
 def create_new_columns(parsed_df):
     parsed_df['occurrenceStatus'] = parsed_df.apply(find_occurrenceStatus, axis=1)
     parsed_df['basisOfRecord'] = parsed_df.apply(find_basisOfRecord, axis='columns')
@@ -164,25 +611,23 @@ def create_folder_structure(odv_zip):
     '''
     Create a directory structure next to the odv_zip file:
     > <some-file>.zip
-    > ./meta.zip
-
-    > ./<some-file>/unzip
-    > ./<some-file>/unzip/odv1.csv, odv2.csv ...
+    > ./meta.zip (containing <some-file>.csv)
 
     > ./<some-file>/dwc
     > ./<some-file>/dwc/occ.csv
     > ./<some-file>/dwc/event.csv
     > ./<some-file>/dwc/emof.csv
+    > ./<some-file>/dwc/all.parquet (see store_helper)
+    > ./<some-file>/dwc/dwca.zip (see dwca_helper)
+    > ./<some-file>/dwc/stage_report.json (see stage_metrics)
+
+    The zips are read directly, nothing is extracted.
     '''
     log.debug(f'Creating folder structure for {odv_zip}...')
     zipped_path = pathlib.Path(odv_zip).parent
     meta_zipped_path = zipped_path.joinpath('meta.zip')
 
-    unzip_folder = pathlib.Path(zipped_path).joinpath('unzip')
-    unzip_folder.mkdir(parents=True, exist_ok=True)
-
-    meta_file = pathlib.Path(odv_zip).stem + '.csv'
-    meta_path = unzip_folder.joinpath(meta_file)
+    meta_member = pathlib.Path(odv_zip).stem + '.csv'
 
     dwc_folder = pathlib.Path(zipped_path).joinpath('dwc')
     dwc_folder.mkdir(parents=True, exist_ok=True)
@@ -191,136 +636,326 @@ def create_folder_structure(odv_zip):
     occ_file = pathlib.Path(zipped_path).joinpath('dwc').joinpath('occ.csv')
     emof_file = pathlib.Path(zipped_path).joinpath('dwc').joinpath('emof.csv')
     all_file = pathlib.Path(zipped_path).joinpath('dwc').joinpath('all.csv')
+    report_file = pathlib.Path(zipped_path).joinpath('dwc').joinpath('stage_report.json')
+    dwca_file = pathlib.Path(zipped_path).joinpath('dwc').joinpath('dwca.zip')
 
     folder_dict = {'odv_zip': odv_zip,
                    'meta_zip': meta_zipped_path,
-                   'unzip_folder': unzip_folder,
+                   'meta_member': meta_member,
                    'dwc_path': dwc_folder,
-                   'meta_path': meta_path,
                    'occ_path': occ_file,
                    'emof_path': emof_file,
                    'event_path': event_file,
-                   'all_data_path': all_file}
+                   'all_data_path': all_file,
+                   'stage_report_path': report_file,
+                   'dwca_path': dwca_file}
 
     return folder_dict
 
-def unzip(folder_dict):
+def list_odv_members(folder_dict):
     '''
-    Unzips the ODV file into the unzip folder
+    List the files in the ODV zip, sorted so the order of the rows (and
+    the output files) is reproducible.
     '''
-    log.debug(f"Unzipping file {folder_dict.get('odv_zip')} into {folder_dict.get('unzip_folder')}...")
     with zipfile.ZipFile(folder_dict.get('odv_zip'), 'r') as zip_ref:
-        zip_ref.extractall(folder_dict.get('unzip_folder'))
+        members = sorted(info.filename for info in zip_ref.infolist() if not info.is_dir())
+    log.debug(f"{len(members)} files in {folder_dict.get('odv_zip')}")
+    return members
 
-    log.debug(f"Unzipping Metadata file {folder_dict.get('meta_zip')} into {folder_dict.get('unzip_folder')}...")
+def read_metadata_csv(folder_dict, **read_csv_args):
+    '''
+    Read the CDI metadata csv straight out of meta.zip
+    '''
     with zipfile.ZipFile(folder_dict.get('meta_zip'), 'r') as zip_ref:
-        zip_ref.extractall(folder_dict.get('unzip_folder'))
-
-    return
-
-def parse_odv(folder_dict):
+        csv_members = [x for x in zip_ref.namelist() if x.endswith('.csv')]
+        member = folder_dict.get('meta_member')
+        if member not in csv_members:
+            member = csv_members[0]
+        log.debug(f"Reading metadata file {member} from {folder_dict.get('meta_zip')}...")
+        with zip_ref.open(member) as f:
+            return pd.read_csv(f, **read_csv_args)
+
+class ZipODVStruct(pyodv.ODV_Struct):
     '''
-    Parse all the ODV files in the unzipped path into
-    a single data object.
+    pyodv.ODV_Struct that parses the ODV text from memory instead of
+    reading it from a file on disk.
     '''
-    unzipped_path = folder_dict.get('unzip_folder')
-    meta_path = folder_dict.get('meta_path')
-
-    log.debug(f'Parsing files in {unzipped_path}...')
-    config = {'occurrenceStatus_hardcode': 'present'}
-
-    odv_list  = []
-    df_list = []
-    ref_list = []
-    for filename in os.listdir(unzipped_path):
+    def __init__(self, name, content):
+        self.content = content
+        super().__init__(name)
+
+    def read_odv_file(self, odv_path):
+        # Same decoding fallback as pyodv: UTF-8 first, then Latin-1
+        try:
+            lines = self.content.decode('utf8')
+        except UnicodeDecodeError:
+            lines = self.content.decode('latin1')
+        split = lines.rsplit('\n//', 1)
+        self.odv_df = pd.read_csv(io.StringIO(split[1]), sep='\t')
+        self.odv_header = split[0]
+
+def open_odv_member(zip_ref, member, spill_bytes=None, spill_dir=None):
+    '''
+    Parse one member of the ODV zip. Members are parsed from memory,
+    unless they are bigger than ODV_SPILL_BYTES, then they're written
+    to a temporary file in ODV_SPILL_DIR first.
+    '''
+    if spill_bytes is None:
+        spill_bytes = int(os.getenv('ODV_SPILL_BYTES', 256 * 1024 * 1024))
+    if spill_dir is None:
+        spill_dir = os.getenv('ODV_SPILL_DIR')
+
+    info = zip_ref.getinfo(member)
+    if info.file_size <= spill_bytes:
+        with stage_metrics.stage('unzip'):
+            content = zip_ref.read(info)
+        return ZipODVStruct(member, content)
+
+    log.debug(f'Spilling {member} ({info.file_size} bytes) to disk...')
+    with stage_metrics.stage('unzip'), tempfile.NamedTemporaryFile(dir=spill_dir, suffix='.txt', delete=False) as tmp:
+        with zip_ref.open(info) as src:
+            shutil.copyfileobj(src, tmp)
+    try:
+        return pyodv.ODV_Struct(tmp.name)
+    finally:
+        os.remove(tmp.name)
 
-        f = os.path.join(unzipped_path, filename)
-        # checking if it is a file
-        if os.path.isfile(f):
+def parse_odv_members(odv_zip, members):
+    '''
+    Parse members of the ODV zip into dataframes, with the scope and defined_by
+    of the file already attached, and their header refs/params.
+    Gives None for members that aren't parsable ODV files. This runs in the
+    worker processes when parsing in parallel.
+    '''
+    results = []
+    with zipfile.ZipFile(odv_zip, 'r') as zip_ref:
+        for member in members:
             try:
-                log.debug(f'===== {f} =====')
-                parsed_file = pyodv.ODV_Struct(f)
-                odv_list.append(parsed_file)
-                ref_list.append(parsed_file.refs[0])
+                log.debug(f'===== {member} =====')
+                parsed_file = open_odv_member(zip_ref, member)
                 this_df = pd.concat([parsed_file.df_data, parsed_file.df_var],axis=1)
                 this_df['scope'] = parsed_file.refs[0]['@sdn:scope'].split(':')[-1]
                 this_df['defined_by'] = parsed_file.refs[0]['@xlink:href']
-                df_list.append(this_df)
+                results.append((this_df, ODVHeader(member, parsed_file.refs, parsed_file.params)))
             except Exception as err:
                 log.debug(err)
+                results.append(None)
+    return results
+
+def iter_odv_files(odv_zip, members, workers=None):
+    '''
+    Parse a list of ODV zip members, across a pool of ODV_PARSE_WORKERS processes
+    if that is more than 1. Results are yielded in the order of members, with at
+    most two batches per worker in flight so the parsed files don't pile up in
+    memory when the consumer is slower than the workers.
+    '''
+    if workers is None:
+        workers = int(os.getenv('ODV_PARSE_WORKERS', 1))
+    if workers <= 1 or len(members) <= 1:
+        for member in members:
+            yield from parse_odv_members(odv_zip, [member])
+        return
+
+    log.debug(f'Parsing {len(members)} files with {workers} processes...')
+    # Every task opens the zip once for a batch of members
+    batch_size = max(1, min(64, len(members) // (workers * 4)))
+    batches = [members[i:i + batch_size] for i in range(0, len(members), batch_size)]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        for batch in batches:
+            pending.append(pool.submit(parse_odv_members, odv_zip, batch))
+            if len(pending) >= workers * 2:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+
+def parse_odv_files(odv_zip, members, workers=None):
+    '''
+    Parse a list of ODV zip members, see iter_odv_files.
+    '''
+    return list(iter_odv_files(odv_zip, members, workers))
+
+def iter_odv_chunks(folder_dict, meta_index, chunk_rows):
+    '''
+    Parse the ODV zip lazily and yield (merged_df, odv_list) chunks of whole ODV
+    files joined with the metadata (see index_metadata), each holding at least
+    chunk_rows rows (except the last one).
+    '''
+    odv_list  = []
+    df_list = []
+    n_rows = 0
+    for result in iter_odv_files(folder_dict.get('odv_zip'), list_odv_members(folder_dict)):
+        if result is None:
+            continue
+        df_list.append(result[0])
+        odv_list.append(result[1])
+        n_rows += len(result[0])
+        if n_rows >= chunk_rows:
+            yield join_metadata(pd.concat(df_list, axis=0), meta_index), odv_list
+            odv_list, df_list, n_rows = [], [], 0
+    if df_list:
+        yield join_metadata(pd.concat(df_list, axis=0), meta_index), odv_list
+
+@stage_metrics.timed('parse_odv')
+def parse_odv(folder_dict, meta_index=None):
+    '''
+    Parse all the ODV files in the ODV zip into
+    a single data object, joined with the metadata (see index_metadata).
+    '''
+    odv_zip = folder_dict.get('odv_zip')
+    log.debug(f'Parsing files in {odv_zip}...')
+    members = list_odv_members(folder_dict)
 
-    metadata_path =  meta_path
+    odv_list  = []
+    df_list = []
+    for result in parse_odv_files(odv_zip, members):
+        if result is not None:
+            df_list.append(result[0])
+            odv_list.append(result[1])
+
+    if meta_index is None:
+        meta_index = index_metadata(load_metadata(folder_dict))
+    merged_df = join_metadata(pd.concat(df_list, axis=0), meta_index)
+    return merged_df, odv_list
+
+@stage_metrics.timed('load_metadata')
+def load_metadata(folder_dict):
+    '''
+    Read the CDI metadata csv, once per conversion: the same frame is used for
+    the join and for the metadata events/EMOF. The text columns get the types
+    of META_DTYPES, the numbers are left to pandas so they're written like before.
+    The index is the LOCAL_CDI_ID key the ODV files use (the part before the '/').
+    '''
     try:
-        log.debug(f'Reading metadata file: {metadata_path}...')
-        metadata_df = pd.read_csv(metadata_path)
-        metadata_df['LOCAL_CDI_ID_split'] = metadata_df['LOCAL_CDI_ID'].str.split(pat="/").str[0]
+        metadata_df = read_metadata_csv(folder_dict, dtype=META_DTYPES)
     except:
         log.warning('Problem with reading metadata file!')
-        metadata_df = pd.DataFrame()
-
-    merged_df = pd.concat(df_list, axis=0)
-    merged_df = merged_df.join(metadata_df.set_index('LOCAL_CDI_ID_split'), on='LOCAL_CDI_ID', how='left', rsuffix = '_meta')
+        return pd.DataFrame(index=pd.Index([], name=META_KEY))
+    metadata_df.index = pd.Index(metadata_df['LOCAL_CDI_ID'].str.split(pat="/").str[0], name=META_KEY)
+    log.info(f'   -Metadata: {len(metadata_df)} rows, '
+             f'{metadata_df.memory_usage(deep=True).sum() / 2 ** 20:.1f} MB in memory')
+    return metadata_df
+
+@stage_metrics.timed('index_metadata')
+def index_metadata(metadata_df):
+    '''
+    The metadata to join onto the ODV rows, once per conversion: only the
+    META_JOIN_COLUMNS, with a unique key so the join never adds rows. A CDI
+    that is in the metadata more than once keeps its first row.
+    '''
+    meta_index = metadata_df[[x for x in META_JOIN_COLUMNS if x in metadata_df.columns]]
+    if not meta_index.index.is_unique:
+        duplicated = meta_index.index.duplicated()
+        duplicate_keys = meta_index.index[duplicated].unique()
+        log.warning(f'   -{len(duplicate_keys)} LOCAL_CDI_IDs are in the metadata more than once, '
+                    f'using their first row: {", ".join(map(str, duplicate_keys[:10]))}'
+                    f'{" ..." if len(duplicate_keys) > 10 else ""}')
+        meta_index = meta_index[~duplicated]
+    return meta_index
+
+@stage_metrics.timed('join_metadata')
+def join_metadata(merged_df, meta_index):
+    '''
+    Join the parsed ODV data with the metadata (see index_metadata) on
+    LOCAL_CDI_ID, and report the CDIs that have no metadata.
+    '''
+    cdi_ids = pd.Index(merged_df['LOCAL_CDI_ID'].dropna().unique())
+    missing = cdi_ids.difference(meta_index.index)
+    if len(missing):
+        log.warning(f'   -{len(missing)} of {len(cdi_ids)} LOCAL_CDI_IDs have no metadata: '
+                    f'{", ".join(map(str, missing[:10]))}{" ..." if len(missing) > 10 else ""}')
+    merged_df = merged_df.join(meta_index, on='LOCAL_CDI_ID', how='left', rsuffix = '_meta')
     merged_df.reset_index(level=None, drop=True, inplace = True)
-    return merged_df, odv_list
+    return merged_df
 
-def create_IDs(row):
+@stage_metrics.timed('create_IDs')
+def create_IDs(df):
     '''
-    Create EventID and OccurrenceID.
+    Create EventID and OccurrenceID for every row of the dataframe.
     Both are a concatenation of the other columns. They also become the columns to join on in the Occurrence Table
-    and Event table.
+    and Event table. The columns are looked up once per dataframe and only the unique keys are hashed.
+    Numbers are written as floats (see id_text), so the IDs don't depend on how the order was split up.
     '''
     # ==== Event ID ====
-    eventID_columns = ['LOCAL_CDI_ID',
-                        'Station',
-                        'yyyy-mm-ddThh:mm:ss.sss',
-                        'YYYY-MM-DDThh:mm:ss.sss',
-                        'Samplingprotocol',
-                        'SamplingProtocol',
-                        'maximumDepthInMeters',
-                        'MaximumObservationDepth',
-                        'minimumDepthInMeters',
-                        'MinimumObservationDepth']
-
-    new_col = []
-    for col in eventID_columns:
-        if col in row.index:
-            new_col.append(str(row[col]))
-    pattern = re.compile(r'\s+')
-    long_eventID = re.sub(pattern, '', '_'.join(new_col))
+    long_eventID = None
+    for col in EVENT_ID_COLUMNS:
+        if col in df.columns:
+            col_str = map_unique(df[col], id_text)
+            long_eventID = col_str if long_eventID is None else long_eventID + '_' + col_str
+    if long_eventID is None:
+        long_eventID = pd.Series('', index=df.index, dtype=object)
     # Create hash of long_eventID since the downstream tools can't handle eventID's longer than 255 chars
-    eventID = hashlib.sha1(long_eventID.encode("UTF-8")).hexdigest()[:20]
-
+    pattern = re.compile(r'\s+')
+    eventID = map_unique(long_eventID, lambda x: hashlib.sha1(re.sub(pattern, '', x).encode("UTF-8")).hexdigest()[:20])
 
     # ==== Ahpia ID ====
-    try:
-        scinameID_col = [i for i in row.index if i.startswith('ScientificNameID')]
-        sciname_col = [i for i in row.index if i.startswith('ScientificName')]
-        if pd.isnull(row[scinameID_col[0]]):
-            aphia_id = row[sciname_col[0]].replace(' ','_')
-        else:
-            # Find the AphiaID from the ScinameID Column
-            aphia_id = re.findall(r"\d{1,}$", row[scinameID_col[0]])[0]
-    except Exception as err:
-        log.error('Failed to find AphiaID...')
-        print(err)
+    scinameID_col = [i for i in df.columns if i.startswith('ScientificNameID')]
+    sciname_col = [i for i in df.columns if i.startswith('ScientificName')]
+    subsamples = [i for i in df.columns if i.startswith('SubsampleID')]
+    sample = [i for i in df.columns if i.startswith('SampleID')]
+    if not (scinameID_col and sample):
+        log.error('Failed to find AphiaID/SampleID columns...')
+        raise KeyError('ScientificNameID and SampleID columns are required to create occurrence IDs')
+    sciname = df[sciname_col[0]]
+    sciname_id = df[scinameID_col[0]]
+
+    def aphia_from_id(x):
+        # Find the AphiaID from the ScinameID Column
+        found = re.findall(r"\d{1,}$", x) if isinstance(x, str) else []
+        return found[0] if found else None
+
+    def aphia_from_name(x):
+        return x.replace(' ','_') if isinstance(x, str) else None
+
+    aphia_id = map_unique(sciname_id, aphia_from_id).where(sciname_id.notna(), map_unique(sciname, aphia_from_name))
+    failed = aphia_id.isna()
+    if failed.any():
+        log.error(f'Failed to find AphiaID for {failed.sum()} rows...')
+        aphia_id = aphia_id.fillna(map_unique(sciname, aphia_from_name))
 
     # ==== occ ID ====
-    subsamples = [i for i in row.index if i.startswith('SubsampleID')]
-    sample = [i for i in row.index if i.startswith('SampleID')]
     # get 8 chars from the hashed sci-name col
-    # Added .iloc[index] because treating keys as position is deprecated and it will raise an error in the future if not changed
-    sciname_str = str(row[sciname_col].iloc[0])
-    hash = hashlib.sha1(sciname_str.encode("UTF-8")).hexdigest()[:10]
+    hash = map_unique(sciname, lambda x: hashlib.sha1(str(x).encode("UTF-8")).hexdigest()[:10])
 
-    if len(subsamples) == 0:
-        occurrenceID = str(row[sample[0]]) + '_' + str(aphia_id) + '_' + str(hash)
-    else:
-        occurrenceID = str(row[sample[0]]) + '_' + str(row[subsamples[0]]) + '_' + str(aphia_id) + '_' + str(hash)
+    occurrenceID = map_unique(df[sample[0]], id_text) + '_'
+    if len(subsamples) > 0:
+        occurrenceID = occurrenceID + map_unique(df[subsamples[0]], id_text) + '_'
+    occurrenceID = occurrenceID + map_unique(aphia_id, str) + '_' + hash
 
     # ==== Parent Event ID ====
-    parentEventID = row['LOCAL_CDI_ID']
+    parentEventID = df['LOCAL_CDI_ID']
+
+    return pd.DataFrame({'eventID': eventID,
+                         'occurrenceID': occurrenceID,
+                         'parentEventID': parentEventID}, index=df.index)
+
+def id_text(x):
+    '''
+    Text of a value in an ID. Integers are written as floats: a column is read
+    as integers from an ODV file without blanks and as floats from one with
+    blanks, and the IDs of a row can't depend on the other rows of its file,
+    chunk or order (5 and 5.0 are both '5.0').
+    '''
+    if isinstance(x, (int, np.integer)) and not isinstance(x, (bool, np.bool_)):
+        return str(float(x))
+    return str(x)
 
-    return eventID, occurrenceID, parentEventID
+def map_unique(series, func):
+    '''
+    Apply func to each distinct value of the series only once and broadcast
+    the results back onto all the rows. Missing values in object columns are
+    passed through one by one since None and NaN would otherwise be merged.
+    '''
+    if isinstance(series, pd.DataFrame):
+        # Duplicate column names, take the first one
+        series = series.iloc[:, 0]
+    result = np.empty(len(series), dtype=object)
+    missing = series.isna().to_numpy() if series.dtype == object else np.zeros(len(series), dtype=bool)
+    codes, uniques = pd.factorize(series[~missing], use_na_sentinel=False)
+    result[~missing] = np.array([func(x) for x in uniques], dtype=object)[codes]
+    if missing.any():
+        result[missing] = [func(x) for x in series[missing]]
+    return pd.Series(result, index=series.index, dtype=object)
 
 def check_IDs(dff, id_col):
     '''
@@ -335,30 +970,93 @@ def check_IDs(dff, id_col):
     else:
         return False
 
-def create_wkt(row):
+@stage_metrics.timed('create_wkt')
+def create_wkt(df):
     '''
-    Create WKT from the dataset for each row
-    Uses Latitude 1,Latitude 2,Longitude 1,Longitude 2
-    from metadata. Must return uncertainty in meters.
+    Create WKT and coordinate uncertainty (in meters) for every row of the
+    dataset. Uses Latitude 1,Latitude 2,Longitude 1,Longitude 2 from metadata.
+    Most rows share the same bounding box from the CDI metadata, so the work is
+    only done once per distinct box and then broadcast back onto the rows.
+    Returns a dataframe with 'CoordinateUncertaintyInMeters' and 'footprint_wkt'
+    aligned with the index of df.
     '''
-
-    try:
-        max_lat = max(row['Latitude 1'], row['Latitude 2'])
-        min_lat = min(row['Latitude 1'], row['Latitude 2'])
-        max_lon = max(row['Longitude 1'], row['Longitude 2'])
-        min_lon = min(row['Longitude 1'], row['Longitude 2'])
-        bounding_wkt = f"POLYGON (({min_lon} {min_lat}, {min_lon} {max_lat}, {max_lon} {max_lat}, {max_lon} {min_lat}, {min_lon} {min_lat}))"
-
-        lat_c = (max_lat + min_lat)/2
-        lon_c = (max_lon + min_lon)/2
-
-        coord_uncertainty = geopy.distance.geodesic((min_lon, min_lat), (lon_c, lat_c)).m
-
-    except Exception as err:
-        print(err)
-        bounding_wkt = None
-        coord_uncertainty = None
-    return coord_uncertainty, bounding_wkt
+    box_columns = BOX_COLUMNS
+    wkt_df = pd.DataFrame({'CoordinateUncertaintyInMeters': np.nan, 'footprint_wkt': None}, index=df.index)
+    if not set(box_columns).issubset(df.columns):
+        log.warning('No bounding box columns in dataset, skipping WKT...')
+        return wkt_df
+
+    # Deduplicate the boxes, the codes map every row back onto its unique box
+    row_keys = pd.util.hash_pandas_object(df[box_columns], index=False).to_numpy()
+    box_codes, _ = pd.factorize(row_keys)
+    _, first_rows = np.unique(box_codes, return_index=True)
+    boxes = df[box_columns].iloc[first_rows]
+    log.debug(f'     -{len(boxes)} unique bounding boxes for {len(df)} rows')
+
+    lat1, lat2, lon1, lon2 = [pd.to_numeric(boxes[col], errors='coerce').to_numpy(dtype='float64') for col in box_columns]
+    valid = np.isfinite(lat1) & np.isfinite(lat2) & np.isfinite(lon1) & np.isfinite(lon2)
+    valid &= (np.abs(lat1) <= 90) & (np.abs(lat2) <= 90)
+
+    min_lat, max_lat = np.minimum(lat1, lat2), np.maximum(lat1, lat2)
+    min_lon, max_lon = np.minimum(lon1, lon2), np.maximum(lon1, lon2)
+    lat_c = (max_lat + min_lat)/2
+    lon_c = (max_lon + min_lon)/2
+    coord_uncertainty = np.where(valid, geodesic_distance(min_lat, min_lon, lat_c, lon_c), np.nan)
+
+    # Format with the original values so the WKT text matches the metadata file
+    raw = [boxes[col].to_numpy(dtype=object) for col in box_columns]
+    bounding_wkt = np.array([None] * len(boxes), dtype=object)
+    for i in np.flatnonzero(valid):
+        lat_a, lat_b, lon_a, lon_b = (x[i] for x in raw)
+        s_min_lat, s_max_lat = min(lat_a, lat_b), max(lat_a, lat_b)
+        s_min_lon, s_max_lon = min(lon_a, lon_b), max(lon_a, lon_b)
+        bounding_wkt[i] = f"POLYGON (({s_min_lon} {s_min_lat}, {s_min_lon} {s_max_lat}, {s_max_lon} {s_max_lat}, {s_max_lon} {s_min_lat}, {s_min_lon} {s_min_lat}))"
+
+    wkt_df['CoordinateUncertaintyInMeters'] = coord_uncertainty[box_codes]
+    wkt_df['footprint_wkt'] = bounding_wkt[box_codes]
+    return wkt_df
+
+def geodesic_distance(lat1, lon1, lat2, lon2, max_iter=200, tol=1e-12):
+    '''
+    Vectorized Vincenty inverse formula on the WGS-84 ellipsoid (the same one
+    geopy uses). Takes arrays of coordinates in degrees and returns the distances
+    in meters. Agrees with geopy.distance.geodesic to well below a millimeter
+    except for nearly antipodal points, which don't occur for bounding boxes.
+    '''
+    a = 6378137.0
+    f = 1/298.257223563
+    b = (1 - f)*a
+
+    lat1, lon1, lat2, lon2 = [np.radians(np.asarray(x, dtype='float64')) for x in (lat1, lon1, lat2, lon2)]
+    L = lon2 - lon1
+    U1 = np.arctan((1 - f)*np.tan(lat1))
+    U2 = np.arctan((1 - f)*np.tan(lat2))
+    sin_U1, cos_U1 = np.sin(U1), np.cos(U1)
+    sin_U2, cos_U2 = np.sin(U2), np.cos(U2)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        lam = L
+        for _ in range(max_iter):
+            sin_lam, cos_lam = np.sin(lam), np.cos(lam)
+            sin_sigma = np.sqrt((cos_U2*sin_lam)**2 + (cos_U1*sin_U2 - sin_U1*cos_U2*cos_lam)**2)
+            cos_sigma = sin_U1*sin_U2 + cos_U1*cos_U2*cos_lam
+            sigma = np.arctan2(sin_sigma, cos_sigma)
+            sin_alpha = np.where(sin_sigma == 0, 0.0, cos_U1*cos_U2*sin_lam/sin_sigma)
+            cos2_alpha = 1 - sin_alpha**2
+            # Equatorial lines have cos2_alpha == 0
+            cos_2sm = np.where(cos2_alpha == 0, 0.0, cos_sigma - 2*sin_U1*sin_U2/cos2_alpha)
+            C = f/16*cos2_alpha*(4 + f*(4 - 3*cos2_alpha))
+            lam_prev = lam
+            lam = L + (1 - C)*f*sin_alpha*(sigma + C*sin_sigma*(cos_2sm + C*cos_sigma*(-1 + 2*cos_2sm**2)))
+            if not np.any(np.abs(lam - lam_prev) > tol):
+                break
+
+        u2 = cos2_alpha*(a**2 - b**2)/b**2
+        A = 1 + u2/16384*(4096 + u2*(-768 + u2*(320 - 175*u2)))
+        B = u2/1024*(256 + u2*(-128 + u2*(74 - 47*u2)))
+        delta_sigma = B*sin_sigma*(cos_2sm + B/4*(cos_sigma*(-1 + 2*cos_2sm**2)
+                                                  - B/6*cos_2sm*(-3 + 4*sin_sigma**2)*(-3 + 4*cos_2sm**2)))
+    return b*A*(sigma - delta_sigma)
 
 
 def find_occurrenceStatus(row):
@@ -385,25 +1083,11 @@ def find_basisOfRecord(row):
 def get_units_from_nerc(measurementUnitID):
     '''
     Get the english units from the nerc vocab
-    server.
-    '''
-    log.debug('   -Downloading vocab from NERC')
-    # nerc_uri = row['measurementUnitID']
-    nerc_uri = measurementUnitID
-    xx = requests.get(nerc_uri + '?_profile=nvs&_mediatype=application/ld+json')
-    # Changed the key 'altLabel' to 'skos:altLabel' because it was changed in the resulting json file from NERC
-    alt_labels = json.loads(xx.content)['skos:altLabel']
-    if isinstance(alt_labels, list):
-        for x in alt_labels:
-            if isinstance(x, str):
-                alt_label = x
-    elif isinstance(alt_labels, str):
-        alt_label = alt_labels
-    else:
-        alt_label = 'Unknown'
-        log.warning(f'Failure to handle Label: {alt_labels}')
-    return alt_label
+    server, through the persistent vocab cache.
+    '''
+    return vocab_helper.get_label(measurementUnitID)
 
+@stage_metrics.timed('convert_params_to_df')
 def convert_params_to_df(odv_list):
     '''
     Convert the ODV Params into Nerc URI's in order to get them
@@ -422,12 +1106,20 @@ def convert_params_to_df(odv_list):
     params_df['measurementType'] = params_df['subject'].apply(lambda x: x.split(':')[-1])
     params_df['measurementUnitID'] = params_df['units'].apply(lambda x: f"https://vocab.nerc.ac.uk/collection/P06/current/{x.split('::')[-1]}/")
     params_df['measurementTypeID'] = params_df['object'].apply(lambda x: f"https://vocab.nerc.ac.uk/collection/P01/current/{x.split('::')[-1]}/")
-    params_df['measurementUnit'] = params_df.apply(lambda x: get_units_from_nerc(x['measurementUnitID']), axis=1)
+    if 'instrument' in params_df.columns:
+        params_df['instrumentID'] = params_df['instrument'].apply(
+            lambda x: f"http://vocab.nerc.ac.uk/collection/L22/current/{x.split('::')[-1]}/" if isinstance(x, str) else None)
+        instrument_uris = params_df['instrumentID'].dropna().tolist()
+    else:
+        instrument_uris = []
 
-    params_df['measurementType'] = params_df['subject'].apply(lambda x: x.split(':')[-1])
-    params_df['measurementUnitID'] = params_df['units'].apply(lambda x: f"https://vocab.nerc.ac.uk/collection/P06/current/{x.split('::')[-1]}/")
-    params_df['measurementTypeID'] = params_df['object'].apply(lambda x: f"https://vocab.nerc.ac.uk/collection/P01/current/{x.split('::')[-1]}/")
-    params_df['measurementUnit'] = params_df.apply(lambda x: get_units_from_nerc(x['measurementUnitID']), axis=1)
+    # Resolve every distinct unit and instrument term up front (concurrently if they're
+    # not cached yet) and join the labels back as columns. The P01 labels aren't used
+    # in the EMOF so those aren't looked up.
+    labels = vocab_helper.get_labels(params_df['measurementUnitID'].tolist() + instrument_uris)
+    params_df['measurementUnit'] = params_df['measurementUnitID'].map(labels)
+    if instrument_uris:
+        params_df['instrumentLabel'] = params_df['instrumentID'].map(labels)
 
     return params_df
 
@@ -446,6 +1138,7 @@ def rename_odv_columns(df):
     df = df.rename(columns = rename_dict)
     return  df
 
+@stage_metrics.timed('odv_dwc_mapping')
 def odv_dwc_mapping(df, map_dict):
     '''
     Take mapping dict and create a new DF that has columns with <map_dict key> as names taken from
@@ -478,72 +1171,96 @@ def odv_dwc_mapping(df, map_dict):
     mapped_df = mapped_df.drop_duplicates()
     return mapped_df
 
-def emof_gen(in_df, in_emof_df):
+@stage_metrics.timed('emof_gen')
+def emof_gen(in_df, in_emof_df, chunk_rows=None):
     '''
     Create EMOF table from the emof_params.
-    Loops through each
+    The measurement columns are melted into long format and joined with the
+    parameter metadata on scope/measurementType in one merge. This is done per
+    chunk of rows (EMOF_CHUNK_ROWS) to keep the long format from blowing up the
+    memory use on large orders.
     '''
     log.info('   -Generating EMOF file...')
     log.info('   -Size of EMOF_DF: '+str(len(in_emof_df)))
-    # out_df = pd.DataFrame()
-    emof_subsets = []
-    for index, row in in_emof_df.iterrows():
-        scope = row['scope']
-        measurementType = row['measurementType']
-        if len(in_df[measurementType].shape) > 1:
-            df_coalesce = in_df[measurementType]
-            df_coalesce["_"] = df_coalesce.bfill(axis=1).iloc[:, 0]
-            in_df = in_df.rename(columns={measurementType: f"_{measurementType}"})
-            in_df[measurementType] = df_coalesce["_"]
-        df_subset = in_df[(in_df[measurementType].notna()) & (in_df['scope'] == scope)][['eventID','occurrenceID',measurementType]]
-        if not df_subset.empty:
-            emof_subset = df_subset.copy()
-            emof_subset['measurementID'] = [uuid.uuid4() for _ in range(len(emof_subset.index))]
-            emof_subset['measurementValue'] = emof_subset[measurementType]
-            emof_subset['measurementValueID'] = None
-            emof_subset['measurementType'] = measurementType
-            emof_subset['measurementTypeID'] = row['measurementTypeID']
-            emof_subset['measurementUnit'] = row['measurementUnit']
-            emof_subset['measurementUnitID'] = row['measurementUnitID']
-            emof_subset = emof_subset[['eventID',
-                                       'occurrenceID',
-                                       'measurementID',
-                                       'measurementValue',
-                                       'measurementValueID',
-                                       'measurementType',
-                                       'measurementTypeID',
-                                       'measurementUnit',
-                                       'measurementUnitID']]
-            emof_subsets.append(emof_subset)
+    if chunk_rows is None:
+        chunk_rows = int(os.getenv('EMOF_CHUNK_ROWS', 500000))
 
-            if 'instrument' in row.index and pd.notna(row.instrument):
-                # This row has tool information
-                emof_tool_subset = df_subset.copy()
-                instrument_uri = f"http://vocab.nerc.ac.uk/collection/L22/current/{row['instrument'].split('::')[-1]}/"
-                emof_tool_subset['measurementID'] = None
-                emof_tool_subset['measurementType'] = 'instrument'
-                emof_tool_subset['measurementTypeID'] = 'http://vocab.nerc.ac.uk/collection/L19/current/SDNKG01/'
-                emof_tool_subset['measurementValue'] = get_units_from_nerc(instrument_uri)
-                emof_tool_subset['measurementValueID'] = instrument_uri
-                emof_tool_subset['measurementUnit'] = 'Dmnless'
-                emof_tool_subset['measurementUnitID'] = 'https://vocab.nerc.ac.uk/collection/P06/current/UUUU/'
-                emof_tool_subset['occurrenceID'] = None
-                emof_tool_subset = emof_tool_subset[['eventID',
-                                                     'occurrenceID',
-                                                     'measurementID',
-                                                     'measurementValue',
-                                                     'measurementValueID',
-                                                     'measurementType',
-                                                     'measurementTypeID',
-                                                     'measurementUnit',
-                                                     'measurementUnitID']]
-                emof_subsets.append(emof_tool_subset)
-    # out_df = out_df[['eventID','occurrenceID','measurementID','measurementValue','measurementValueID','measurementType','measurementTypeID','measurementUnit','measurementUnitID']]
-    log.debug('     -Loop done: dropping dupes in EMOF file...')
-    emod_df = pd.concat(emof_subsets)
-    emod_df = emod_df.drop_duplicates()
+    measurement_types = [x for x in in_emof_df['measurementType'].unique() if x in in_df.columns]
+    missing_types = set(in_emof_df['measurementType']) - set(measurement_types)
+    if missing_types:
+        log.warning(f'     -Measurement columns not found in data: {sorted(missing_types)}')
+
+    param_columns = ['scope', 'measurementType', 'measurementTypeID', 'measurementUnit', 'measurementUnitID']
+    if 'instrumentLabel' in in_emof_df.columns:
+        param_columns += ['instrumentID', 'instrumentLabel']
+    params = in_emof_df[param_columns]
+
+    id_columns = ['eventID', 'occurrenceID', 'scope']
+    emof_subsets = []
+    tool_subsets = []
+    for start in range(0, len(in_df), chunk_rows):
+        chunk = in_df.iloc[start:start + chunk_rows]
+        # Columns that share a name after renaming are coalesced, first non-null value wins
+        values = {x: coalesce_columns(chunk[x]) for x in measurement_types}
+        long_df = pd.concat([chunk[id_columns], pd.DataFrame(values, index=chunk.index)], axis='columns')
+        long_df = long_df.melt(id_vars=id_columns,
+                               value_vars=measurement_types,
+                               var_name='measurementType',
+                               value_name='measurementValue')
+        long_df = long_df[long_df['measurementValue'].notna()]
+        emof_subset = long_df.merge(params, on=['scope', 'measurementType'], how='inner')
+        if emof_subset.empty:
+            continue
+
+        if 'instrumentID' in emof_subset.columns:
+            # Rows with tool information get an extra event level instrument record
+            tool_subset = emof_subset.loc[emof_subset['instrumentID'].notna(), ['eventID', 'instrumentID', 'instrumentLabel']]
+            tool_subsets.append(tool_subset.drop_duplicates())
+
+        emof_subset['measurementID'] = bulk_uuid4(len(emof_subset))
+        emof_subset['measurementValueID'] = None
+        emof_subsets.append(emof_subset[emof_columns])
+
+    if tool_subsets:
+        emof_tool_subset = pd.concat(tool_subsets).drop_duplicates()
+        emof_tool_subset['measurementValueID'] = emof_tool_subset['instrumentID']
+        emof_tool_subset['measurementValue'] = emof_tool_subset['instrumentLabel']
+        emof_tool_subset['occurrenceID'] = None
+        emof_tool_subset['measurementID'] = None
+        emof_tool_subset['measurementType'] = 'instrument'
+        emof_tool_subset['measurementTypeID'] = 'http://vocab.nerc.ac.uk/collection/L19/current/SDNKG01/'
+        emof_tool_subset['measurementUnit'] = 'Dmnless'
+        emof_tool_subset['measurementUnitID'] = 'https://vocab.nerc.ac.uk/collection/P06/current/UUUU/'
+        emof_subsets.append(emof_tool_subset[emof_columns])
+
+    log.debug(f'     -Melted {len(measurement_types)} measurement columns into {sum(len(x) for x in emof_subsets)} EMOF rows')
+    if not emof_subsets:
+        return pd.DataFrame(columns=emof_columns)
+    emod_df = pd.concat(emof_subsets, ignore_index=True)
     return emod_df
 
+def coalesce_columns(col):
+    '''
+    Selecting a column name that occurs more than once gives a dataframe,
+    combine those into a single column by taking the first non-null value.
+    '''
+    if isinstance(col, pd.DataFrame):
+        return col.bfill(axis=1).iloc[:, 0]
+    return col
+
+def bulk_uuid4(n):
+    '''
+    Generate n random (version 4) UUID strings from a single read of the
+    OS random source.
+    '''
+    raw = np.frombuffer(os.urandom(16*n), dtype=np.uint8).reshape(n, 16).copy()
+    # Set the version and variant bits
+    raw[:, 6] = (raw[:, 6] & 0x0F) | 0x40
+    raw[:, 8] = (raw[:, 8] & 0x3F) | 0x80
+    h = raw.tobytes().hex()
+    return [f'{h[i:i+8]}-{h[i+8:i+12]}-{h[i+12:i+16]}-{h[i+16:i+20]}-{h[i+20:i+32]}' for i in range(0, 32*n, 32)]
+
+@stage_metrics.timed('emof_cleanup')
 def emof_cleanup(emof_df, occ_mapping, event_mapping):
     '''
     Any measurementType that is also in the Occ or Event tables must be ignored. Also drop rows
@@ -565,18 +1282,22 @@ def emof_cleanup(emof_df, occ_mapping, event_mapping):
     emof_df = emof_df.reset_index(drop=True)
     return emof_df
 
-def meta_event_gen(folder_dict):
+@stage_metrics.timed('meta_event_gen')
+def meta_event_gen(folder_dict, metadata_df=None):
     '''
-    Grab the metadata file and create an event core file from it
+    Grab the metadata (see load_metadata) and create an event core file from it
     '''
     log.debug('   -Converting metafile into params dataframe...')
-    meta_df =  pd.read_csv(folder_dict.get('meta_path'), dtype={'Depth reference': 'object'})
-    meta_df['eventID'] = meta_df['LOCAL_CDI_ID'].str.split(pat="/").str[0]
+    if metadata_df is None:
+        metadata_df = load_metadata(folder_dict)
+    meta_df = metadata_df.reset_index(drop=True)
+    meta_df['eventID'] = metadata_df.index.to_numpy()
     meta_df = create_new_columns(meta_df)
     meta_events = odv_dwc_mapping(meta_df, meta_event_mapping)
     return meta_events
 
-def meta_emof_gen(folder_dict):
+@stage_metrics.timed('meta_emof_gen')
+def meta_emof_gen(folder_dict, metadata_df=None):
     '''
     Convert the ODV Metadata file into an EMOF starter file.
     Much of this is hard coded since there isn't too much semantic info
@@ -585,7 +1306,9 @@ def meta_emof_gen(folder_dict):
     log.debug('   -Converting metafile into emof dataframe...')
 
 
-    meta_df =  pd.read_csv(folder_dict.get('meta_path'))
+    if metadata_df is None:
+        metadata_df = load_metadata(folder_dict)
+    meta_df = metadata_df.reset_index()
     # meta_params = convert_meta_params_to_df(meta_df)
 
     template_meta_emofs = [{'measurementType': 'Minimum instrument depth (m)',
@@ -625,7 +1348,7 @@ def meta_emof_gen(folder_dict):
 
         if not df_subset.empty:
             emof_subset = df_subset.copy()
-            emof_subset['eventID'] = emof_subset['LOCAL_CDI_ID'].str.split(pat="/").str[0]
+            emof_subset['eventID'] = emof_subset[META_KEY]
             emof_subset['occurrenceID'] = None
             emof_subset['measurementID'] = None
             emof_subset['measurementTypeID'] = None
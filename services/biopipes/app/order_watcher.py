@@ -0,0 +1,183 @@
+'''
+Polls the placed orders on their own schedule, instead of on the check
+interval of their job. Every pending order gets a one off scheduled poll,
+which schedules the next one until the order is ready:
+
+- while lines of the order get ready the next poll is planned for when the
+  rest should be ready, from the progress since the last poll
+- without progress the delay grows exponentially (ORDER_POLL_FACTOR)
+- when all the lines are ready it's polled again soon, the download links
+  only have to be generated
+
+Delays are kept between ORDER_POLL_MIN_SECS and ORDER_POLL_MAX_SECS. The
+other orders due within ORDER_POLL_BATCH_SECS of a poll are polled along
+with it, concurrently. As soon as an order has download links,
+on_ready(job_dict, order_status) is called to start the download.
+'''
+
+import os
+import time
+import logging
+import datetime
+import threading
+
+from apscheduler.jobstores.base import JobLookupError
+
+import app.db_helper as db_helper
+
+log = logging.getLogger('order_watcher')
+
+
+class OrderWatcher:
+    def __init__(self, scheduler, executor, api_client, on_ready):
+        self.scheduler = scheduler
+        self.executor = executor
+        self.api_client = api_client
+        self.on_ready = on_ready
+        self.min_secs = int(os.getenv('ORDER_POLL_MIN_SECS', 30))
+        self.max_secs = int(os.getenv('ORDER_POLL_MAX_SECS', 1800))
+        self.factor = float(os.getenv('ORDER_POLL_FACTOR', 2))
+        self.batch_secs = int(os.getenv('ORDER_POLL_BATCH_SECS', 10))
+        self.lock = threading.Lock()
+        # job_id -> {'attempt', 'ready', 'polled'} of the watched orders
+        self.orders = {}
+
+    def watching(self, job_id):
+        with self.lock:
+            return job_id in self.orders
+
+    def watch(self, job_id, delay=None):
+        '''
+        Start watching the order of a job, the first poll is after delay
+        seconds (ORDER_POLL_MIN_SECS by default). Orders that are watched
+        already keep their schedule.
+        '''
+        with self.lock:
+            if job_id in self.orders:
+                return
+            self.orders[job_id] = {'attempt': 0, 'ready': None, 'polled': None}
+        log.info('Watching the order of job {0}'.format(job_id))
+        self.schedule(job_id, self.min_secs if delay is None else delay)
+
+    def unwatch(self, job_id):
+        with self.lock:
+            self.orders.pop(job_id, None)
+        scheduled = self.scheduler.get_job(f'order-{job_id}')
+        if scheduled is not None:
+            scheduled.remove()
+
+    def schedule(self, job_id, delay):
+        run_date = datetime.datetime.now(self.scheduler.timezone) + datetime.timedelta(seconds=delay)
+        self.scheduler.add_job(self.poll, 'date', run_date=run_date, args=[job_id],
+                               id=f'order-{job_id}', name=f'poll order of job {job_id}', replace_existing=True)
+
+    def poll_delay(self, job_id, order_status):
+        '''
+        Seconds until the next poll of an order that isn't ready, from the
+        order lines processing/ready for download
+        '''
+        lines = order_status.get('order_lines') or 0
+        ready = order_status.get('order_lines_ready_for_download') or 0
+        processing = order_status.get('order_lines_processing') or 0
+        now = time.monotonic()
+        with self.lock:
+            state = self.orders.setdefault(job_id, {'attempt': 0, 'ready': None, 'polled': None})
+            if lines and ready >= lines and not processing:
+                # Only the download links are missing
+                state['attempt'] = 0
+                delay = self.min_secs
+            elif state['ready'] is not None and ready > state['ready'] and now > state['polled']:
+                # Expect the other lines at the same rate
+                state['attempt'] = 0
+                rate = (ready - state['ready']) / (now - state['polled'])
+                delay = (lines - ready) / rate
+            else:
+                delay = self.min_secs * self.factor ** state['attempt']
+                state['attempt'] += 1
+            state['ready'] = ready
+            state['polled'] = now
+        log.debug(f'Order of job {job_id}: {ready}/{lines} lines ready, {processing} processing')
+        return min(max(delay, self.min_secs), self.max_secs)
+
+    def due_orders(self, job_id):
+        '''
+        The other watched orders whose poll is due within ORDER_POLL_BATCH_SECS,
+        their scheduled polls are taken over by the poll of job_id
+        '''
+        until = datetime.datetime.now(self.scheduler.timezone) + datetime.timedelta(seconds=self.batch_secs)
+        with self.lock:
+            watched = [x for x in self.orders if x != job_id]
+        due = []
+        for other_id in watched:
+            scheduled = self.scheduler.get_job(f'order-{other_id}')
+            if scheduled is None or scheduled.next_run_time is None or scheduled.next_run_time > until:
+                continue
+            try:
+                scheduled.remove()
+            except JobLookupError:
+                # Its poll started already
+                continue
+            due.append(other_id)
+        return due
+
+    def poll(self, job_id):
+        '''
+        Scheduled poll of the order of a job, and of the other orders that are
+        due. The job rows are read again, so orders that are no longer pending
+        are dropped.
+        '''
+        job_ids = [job_id] + self.due_orders(job_id)
+        # The orders of this poll that have no next poll or download yet
+        pending = list(job_ids)
+        try:
+            running_jobs = self.executor.running_jobs()
+            job_dicts = []
+            for this_id in job_ids:
+                if this_id in running_jobs:
+                    log.info('Job {0} is still being downloaded/converted, not polling its order'.format(this_id))
+                    self.unwatch(this_id)
+                    pending.remove(this_id)
+                    continue
+                job_dict = db_helper.get_store().get_job(this_id)
+                if job_dict is None or not job_dict.get('active') or not job_dict.get('order_placed'):
+                    log.info('Job {0} has no pending order anymore, not watching it'.format(this_id))
+                    self.unwatch(this_id)
+                    pending.remove(this_id)
+                    continue
+                job_dicts.append(job_dict)
+            if not job_dicts:
+                return
+
+            if len(job_dicts) > 1:
+                log.debug('Polling {0} orders at once'.format(len(job_dicts)))
+            # Failed polls are logged and come back as None
+            order_statuses = self.api_client.get_orders(job_dicts)
+            for job_dict in job_dicts:
+                try:
+                    self.handle_status(job_dict, order_statuses.get(job_dict.get('job_id')))
+                    pending.remove(job_dict.get('job_id'))
+                except Exception as e:
+                    # Polled again with the rest, the other orders of the batch go on
+                    log.error('Error handling order {0} of job {1}: {2}'.format(job_dict.get('order_id'), job_dict.get('job_id'), e))
+        except Exception as e:
+            log.error('Error polling the orders of jobs {0}: {1}'.format(pending, e))
+        finally:
+            # Their scheduled polls are gone, keep them polled
+            for this_id in pending:
+                if self.watching(this_id):
+                    self.schedule(this_id, self.min_secs)
+
+    def handle_status(self, job_dict, order_status):
+        '''
+        Start the download of a ready order, or plan its next poll
+        '''
+        job_id = job_dict.get('job_id')
+        if order_status is not None and order_status.get('downloads') is not None:
+            log.info('Order {0} is ready for download'.format(job_dict.get('order_id')))
+            self.unwatch(job_id)
+            self.on_ready(job_dict, order_status)
+            return
+
+        delay = self.poll_delay(job_id, order_status or {})
+        log.info('Order {0} is not ready for download, polling again in {1:.0f}s'.format(job_dict.get('order_id'), delay))
+        self.schedule(job_id, delay)
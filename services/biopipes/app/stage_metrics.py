@@ -0,0 +1,236 @@
+'''
+Instrumentation of the stages of a conversion. While a conversion is
+recorded, every stage records its calls, wall time, CPU time, peak RSS and
+the rows going in and out. A stage that runs more than once (per chunk or
+per ODV file) adds up, stages can be nested (unzip runs within parse_odv).
+The report is written to the dwc folder of the order:
+
+> ./<some-file>/dwc/stage_report.json
+
+The peak RSS of a stage is the high water mark of the process during the
+stage. On Linux it's reset at the start of every stage, elsewhere it's the
+high water mark since the process started.
+
+Setting PROFILE_JOB_IDS (comma separated) also profiles the conversions of
+those jobs with cProfile (dwc/profile.prof), or pyinstrument (dwc/profile.html)
+when PROFILER=pyinstrument and it's installed.
+'''
+
+import os
+import json
+import time
+import logging
+import datetime
+import resource
+import functools
+from contextlib import contextmanager
+
+log = logging.getLogger('stage_metrics')
+
+STAGE_FIELDS = ['calls', 'wall', 'cpu', 'peak_rss_mb', 'rows_in', 'rows_out']
+
+# The report being recorded in this process, and the last finished one until
+# it's taken (see take_report)
+current_report = None
+finished_report = None
+
+
+def read_hwm():
+    '''
+    High water mark of the RSS of this process, in MB
+    '''
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def reset_hwm():
+    '''
+    Reset the high water mark to the current RSS, where the kernel supports it
+    '''
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+class StageReport:
+    def __init__(self, **info):
+        self.info = info
+        self.stages = {}
+        self.open_stages = []
+
+    def fold_hwm(self):
+        '''
+        Add the high water mark since the last reset to the open stages
+        '''
+        hwm = read_hwm()
+        for name in self.open_stages:
+            stage = self.stages[name]
+            stage['peak_rss_mb'] = max(stage['peak_rss_mb'], hwm)
+        reset_hwm()
+
+    @contextmanager
+    def stage(self, name, rows_in=None):
+        stage = self.stages.setdefault(name, dict.fromkeys(STAGE_FIELDS, 0))
+        self.fold_hwm()
+        self.open_stages.append(name)
+        rows = {'rows_out': None}
+        start_wall, start_cpu = time.perf_counter(), time.process_time()
+        try:
+            yield rows
+        finally:
+            stage['calls'] += 1
+            stage['wall'] += time.perf_counter() - start_wall
+            stage['cpu'] += time.process_time() - start_cpu
+            stage['rows_in'] += rows_in or 0
+            stage['rows_out'] += rows['rows_out'] or 0
+            self.fold_hwm()
+            self.open_stages.remove(name)
+
+    def to_dict(self):
+        return dict(self.info, stages=self.stages)
+
+
+def stage(name, rows_in=None):
+    '''
+    Context manager that records a stage of the current conversion, set
+    rows['rows_out'] on the dict it gives. Does nothing if no conversion
+    is being recorded.
+    '''
+    if current_report is None:
+        return no_stage()
+    return current_report.stage(name, rows_in)
+
+@contextmanager
+def no_stage():
+    yield {'rows_out': None}
+
+def count_rows(result):
+    '''
+    Rows of a dataframe (or list), or of the first one of a tuple
+    '''
+    if isinstance(result, tuple) and result:
+        result = result[0]
+    return len(result) if hasattr(result, 'shape') or isinstance(result, list) else None
+
+def timed(name):
+    '''
+    Decorator that records every call of a function as a stage, the rows
+    in are those of the first argument, the rows out those of the result.
+    '''
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if current_report is None:
+                return func(*args, **kwargs)
+            with current_report.stage(name, count_rows(args[0]) if args else None) as rows:
+                result = func(*args, **kwargs)
+                rows['rows_out'] = count_rows(result)
+            return result
+        return wrapper
+    return decorator
+
+def timed_iter(name, iterable):
+    '''
+    Record every item taken from iterable as a call of a stage, for
+    generators that do their work lazily (like the chunk readers)
+    '''
+    iterator = iter(iterable)
+    while True:
+        with stage(name) as rows:
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            rows['rows_out'] = count_rows(item)
+        yield item
+
+@contextmanager
+def recording(report_path, report_class=StageReport, **info):
+    '''
+    Record the stages run within the block, with a 'total' stage for the
+    whole block, and write the report to report_path when it's done (also
+    if the conversion fails, with the error). report_class can be a
+    StageReport that records more per stage (see bench/run_bench.py).
+    '''
+    global current_report, finished_report
+    report = report_class(started=datetime.datetime.now().isoformat(), **info)
+    current_report = report
+    finished_report = None
+    try:
+        with report.stage('total'):
+            yield report
+    except Exception as e:
+        report.info['error'] = str(e)
+        raise
+    finally:
+        current_report = None
+        finished_report = report.to_dict()
+        write_report(finished_report, report_path)
+
+def write_report(report, report_path):
+    tmp_path = f'{report_path}.tmp'
+    try:
+        with open(tmp_path, 'w') as f:
+            json.dump(report, f, indent=2)
+        os.replace(tmp_path, report_path)
+    except OSError as e:
+        log.warning(f'Could not write the stage report {report_path}: {e}')
+    total = report['stages'].get('total', {})
+    log.info(f'   -Conversion took {total.get("wall", 0):.1f}s ({total.get("cpu", 0):.1f}s CPU), '
+             f'peak RSS {total.get("peak_rss_mb", 0):.0f} MB')
+
+def take_report():
+    '''
+    The report of the last conversion recorded in this process, handed out
+    once: None if nothing was recorded since the last call
+    '''
+    global finished_report
+    report, finished_report = finished_report, None
+    return report
+
+@contextmanager
+def profiling(job_id, folder):
+    '''
+    Profile the block if job_id is in PROFILE_JOB_IDS, the profile is
+    written to folder.
+    '''
+    job_ids = [x.strip() for x in os.getenv('PROFILE_JOB_IDS', '').split(',') if x.strip()]
+    if str(job_id) not in job_ids:
+        yield
+        return
+
+    if os.getenv('PROFILER', 'cprofile') == 'pyinstrument':
+        try:
+            import pyinstrument
+        except ImportError:
+            log.warning('pyinstrument is not installed, profiling with cProfile')
+        else:
+            profiler = pyinstrument.Profiler()
+            profiler.start()
+            try:
+                yield
+            finally:
+                profiler.stop()
+                profile_path = os.path.join(folder, 'profile.html')
+                with open(profile_path, 'w') as f:
+                    f.write(profiler.output_html())
+                log.info(f'   -Profile of job {job_id} written to {profile_path}')
+            return
+
+    import cProfile
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profile_path = os.path.join(folder, 'profile.prof')
+        profiler.dump_stats(profile_path)
+        log.info(f'   -Profile of job {job_id} written to {profile_path}')
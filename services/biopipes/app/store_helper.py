@@ -0,0 +1,144 @@
+'''
+Columnar store for the merged ODV dataset (all the parsed ODV files joined
+with the CDI metadata), written as parquet files partitioned by scope
+(or PARQUET_PARTITION) in the dwc folder:
+
+> ./dwc/all.parquet/scope=<scope>/part-00000.parquet
+> ./dwc/all.parquet/_headers.json
+
+_headers.json keeps the ODV header refs/params needed for the EMOF and the
+zip the store was built from, it's written last so an interrupted run
+doesn't leave a store that looks complete. Retriggers reprocess from the
+store instead of parsing every ODV file again.
+
+Every partition file is read separately and combined with pandas, the ODV
+files don't all have the same columns or types so a single dataset schema
+doesn't fit them.
+'''
+
+import os
+import glob
+import json
+import shutil
+import logging
+import urllib.parse
+
+import pandas as pd
+
+log = logging.getLogger('store_helper')
+
+
+def store_path(folder_dict):
+    return os.path.join(folder_dict.get('dwc_path'), 'all.parquet')
+
+def headers_path(folder_dict):
+    return os.path.join(store_path(folder_dict), '_headers.json')
+
+def clear_store(folder_dict):
+    '''
+    Remove the store of a previous run
+    '''
+    shutil.rmtree(store_path(folder_dict), ignore_errors=True)
+
+def arrow_safe(df):
+    '''
+    Parquet needs one type per column, object columns holding a mix of
+    strings and numbers are stored as strings.
+    '''
+    for col in df.columns[df.dtypes == object]:
+        kind = pd.api.types.infer_dtype(df[col], skipna=True)
+        if kind not in ('string', 'empty', 'bytes'):
+            df[col] = df[col].where(df[col].isna(), df[col].astype(str))
+    return df
+
+def write_store_chunk(merged_df, folder_dict, part):
+    '''
+    Write (a chunk of) the merged dataset into the store, one file per
+    partition value. part numbers the chunks so later chunks don't
+    overwrite earlier files of the same partition.
+    '''
+    partition_col = os.getenv('PARQUET_PARTITION', 'scope')
+    if partition_col not in merged_df.columns:
+        partition_col = 'scope'
+    merged_df = arrow_safe(merged_df.copy())
+    try:
+        for value, part_df in merged_df.groupby(partition_col, sort=False, dropna=False, observed=True):
+            value = '__null__' if pd.isna(value) else urllib.parse.quote(str(value), safe='')
+            part_folder = os.path.join(store_path(folder_dict), f'{partition_col}={value}')
+            os.makedirs(part_folder, exist_ok=True)
+            part_df.to_parquet(os.path.join(part_folder, f'part-{part:05d}.parquet'), index=False)
+    except ImportError as err:
+        log.warning(f'Can not write the parquet store: {err}')
+        return False
+    return True
+
+def write_store_headers(odv_list, folder_dict):
+    '''
+    Write the ODV headers and the source zip, this marks the store complete.
+    '''
+    odv_zip = folder_dict.get('odv_zip')
+    headers = {'odv_zip': str(odv_zip),
+               'odv_zip_mtime': os.path.getmtime(odv_zip),
+               'headers': [odv._asdict() for odv in odv_list]}
+    os.makedirs(store_path(folder_dict), exist_ok=True)
+    with open(headers_path(folder_dict), 'w') as f:
+        json.dump(headers, f)
+
+def write_store(merged_df, odv_list, folder_dict):
+    '''
+    Replace the store with the complete merged dataset
+    '''
+    log.debug(f'   -Writing parquet store {store_path(folder_dict)}...')
+    clear_store(folder_dict)
+    if write_store_chunk(merged_df, folder_dict, 0):
+        write_store_headers(odv_list, folder_dict)
+
+def store_is_valid(folder_dict):
+    '''
+    The store is usable if it's complete and built from the current zip
+    '''
+    try:
+        with open(headers_path(folder_dict)) as f:
+            headers = json.load(f)
+        return headers.get('odv_zip_mtime') == os.path.getmtime(folder_dict.get('odv_zip'))
+    except (OSError, ValueError):
+        return False
+
+def read_store_headers(folder_dict):
+    with open(headers_path(folder_dict)) as f:
+        return json.load(f)['headers']
+
+def store_files(folder_dict):
+    return sorted(glob.glob(os.path.join(store_path(folder_dict), '*', '*.parquet')))
+
+def iter_store_chunks(folder_dict, chunk_rows):
+    '''
+    Yield (merged_df, headers) chunks of the store holding at least chunk_rows
+    rows (except the last one). headers are the ODV headers of the scopes in
+    the chunk.
+    '''
+    headers = read_store_headers(folder_dict)
+    df_list = []
+    n_rows = 0
+    for f in store_files(folder_dict):
+        df_list.append(pd.read_parquet(f))
+        n_rows += len(df_list[-1])
+        if n_rows >= chunk_rows:
+            yield chunk_with_headers(df_list, headers)
+            df_list, n_rows = [], 0
+    if df_list:
+        yield chunk_with_headers(df_list, headers)
+
+def chunk_with_headers(df_list, headers):
+    merged_df = pd.concat(df_list, axis=0, ignore_index=True)
+    scopes = set(merged_df['scope'])
+    chunk_headers = [x for x in headers if x['refs'][0]['@sdn:scope'].split(':')[-1] in scopes]
+    return merged_df, chunk_headers
+
+def read_store(folder_dict):
+    '''
+    Read the whole store back into (merged_df, headers)
+    '''
+    log.debug(f'   -Reading parquet store {store_path(folder_dict)}...')
+    df_list = [pd.read_parquet(f) for f in store_files(folder_dict)]
+    return pd.concat(df_list, axis=0, ignore_index=True), read_store_headers(folder_dict)
@@ -0,0 +1,206 @@
+'''
+Persistent cache for the labels of NERC vocabulary terms (P06 units,
+L22 instruments...) so restarts and new scheduler cycles don't have to
+ask vocab.nerc.ac.uk for every term again.
+
+The cache is a small sqlite DB next to the trigger DB, keyed on the
+term URI. Entries older than VOCAB_CACHE_TTL_DAYS are refreshed, but
+are still used if the vocab server can't be reached.
+
+Setting VOCAB_FIXTURE to a JSON file with {uri: json-ld document or label}
+replaces the vocab server, for testing without network access.
+'''
+
+import os
+import json
+import logging
+import sqlite3
+import datetime
+import time
+from functools import cache
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import requests
+
+log = logging.getLogger('vocab_helper')
+
+NERC_PARAMS = '?_profile=nvs&_mediatype=application/ld+json'
+
+
+def get_cache_path():
+    '''
+    The vocab cache lives next to the trigger DB unless
+    VOCAB_CACHE_DATABASE says otherwise.
+    '''
+    db_file = os.getenv('SQLITE_DATABASE','/etc/sqlite/trigger.db')
+    default_path = os.path.join(os.path.dirname(db_file), 'vocab_cache.db')
+    return os.getenv('VOCAB_CACHE_DATABASE', default_path)
+
+def connect():
+    '''
+    Open the cache DB, creating the table if needed
+    '''
+    con = sqlite3.connect(get_cache_path())
+    con.execute('''CREATE TABLE IF NOT EXISTS vocab(
+                    uri TEXT PRIMARY KEY,
+                    label TEXT NOT NULL,
+                    fetched TEXT NOT NULL
+                );''')
+    return con
+
+def read_cache(uris):
+    '''
+    Return {uri: (label, fetched)} for the uris that are in the cache
+    '''
+    uris = list(uris)
+    cached = {}
+    con = connect()
+    try:
+        # Stay below the sqlite host parameter limit
+        for start in range(0, len(uris), 500):
+            batch = uris[start:start + 500]
+            sql = f"SELECT uri, label, fetched FROM vocab WHERE uri IN ({','.join('?' * len(batch))})"
+            for uri, label, fetched in con.execute(sql, batch):
+                cached[uri] = (label, datetime.datetime.fromisoformat(fetched))
+    finally:
+        con.close()
+    return cached
+
+def write_cache(labels):
+    '''
+    Store {uri: label} in the cache in a single transaction
+    '''
+    if not labels:
+        return
+    now = datetime.datetime.now().isoformat()
+    con = connect()
+    try:
+        with con:
+            con.executemany('INSERT OR REPLACE INTO vocab(uri, label, fetched) VALUES (?, ?, ?)',
+                            [(uri, label, now) for uri, label in labels.items()])
+    finally:
+        con.close()
+
+@cache
+def load_fixture(fixture_path):
+    '''
+    Read the JSON file that stands in for the vocab server
+    '''
+    log.info(f'Using vocab fixture {fixture_path} instead of the NERC vocab server')
+    with open(fixture_path) as f:
+        return json.load(f)
+
+def parse_label(vocab_doc):
+    '''
+    Get the english label out of the json-ld document of a term.
+    '''
+    if isinstance(vocab_doc, str):
+        # Fixtures can give the label directly
+        return vocab_doc
+    # Changed the key 'altLabel' to 'skos:altLabel' because it was changed in the resulting json file from NERC
+    alt_labels = vocab_doc['skos:altLabel']
+    alt_label = 'Unknown'
+    if isinstance(alt_labels, list):
+        for x in alt_labels:
+            if isinstance(x, str):
+                alt_label = x
+    elif isinstance(alt_labels, str):
+        alt_label = alt_labels
+    else:
+        log.warning(f'Failure to handle Label: {alt_labels}')
+    return alt_label
+
+def fetch_label(uri, session=None):
+    '''
+    Get the english label of a term from the nerc vocab
+    server (or from the fixture file).
+    '''
+    fixture_path = os.getenv('VOCAB_FIXTURE')
+    if fixture_path:
+        return parse_label(load_fixture(fixture_path)[uri])
+
+    log.debug(f'   -Downloading vocab from NERC: {uri}')
+    response = (session or requests).get(uri + NERC_PARAMS, timeout=int(os.getenv('VOCAB_TIMEOUT', 30)))
+    response.raise_for_status()
+    return parse_label(json.loads(response.content))
+
+def fetch_with_retry(uri, session, retries, backoff):
+    '''
+    Fetch a label, retrying connection problems and server errors
+    with an exponential backoff.
+    '''
+    for attempt in range(retries + 1):
+        try:
+            return fetch_label(uri, session)
+        except requests.RequestException as err:
+            client_error = err.response is not None and err.response.status_code < 500
+            if client_error or attempt == retries:
+                raise
+            wait = backoff * 2**attempt
+            log.debug(f'Retrying {uri} in {wait}s: {err}')
+            time.sleep(wait)
+
+def fetch_labels(uris):
+    '''
+    Fetch the labels of all the uris concurrently with a bounded pool of
+    workers sharing one HTTP session. Returns {uri: label} for the ones
+    that could be fetched.
+    '''
+    uris = list(uris)
+    if not uris:
+        return {}
+    workers = int(os.getenv('VOCAB_WORKERS', 8))
+    retries = int(os.getenv('VOCAB_RETRIES', 3))
+    backoff = float(os.getenv('VOCAB_BACKOFF', 1))
+    log.info(f'   -Fetching {len(uris)} vocab terms with {workers} workers...')
+
+    labels = {}
+    with requests.Session() as session:
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=workers)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = {pool.submit(fetch_with_retry, uri, session, retries, backoff): uri for uri in uris}
+            for future in as_completed(futures):
+                uri = futures[future]
+                try:
+                    labels[uri] = future.result()
+                except Exception as err:
+                    log.warning(f'Problem fetching vocab term {uri}: {err}')
+    return labels
+
+def get_labels(uris):
+    '''
+    Return {uri: label} for all the uris. Fresh cache entries are used
+    as is, the others are fetched and written back to the cache. When a
+    term can't be fetched the stale cached label is used, or 'Unknown'
+    if there is none.
+    '''
+    uris = set(uri for uri in uris if uri)
+    if not uris:
+        return {}
+    ttl = datetime.timedelta(days=float(os.getenv('VOCAB_CACHE_TTL_DAYS', 30)))
+    now = datetime.datetime.now()
+
+    cached = read_cache(uris)
+    labels = {uri: label for uri, (label, fetched) in cached.items() if now - fetched < ttl}
+    to_fetch = sorted(uris - set(labels))
+    log.debug(f'   -{len(labels)} vocab terms cached, {len(to_fetch)} to fetch')
+
+    fetched = fetch_labels(to_fetch)
+    write_cache(fetched)
+    labels.update(fetched)
+
+    for uri in uris - set(labels):
+        if uri in cached:
+            log.warning(f'Using stale cached label for {uri}')
+            labels[uri] = cached[uri][0]
+        else:
+            labels[uri] = 'Unknown'
+    return labels
+
+def get_label(uri):
+    '''
+    Return the label of a single term
+    '''
+    return get_labels([uri]).get(uri, 'Unknown')
@@ -0,0 +1,91 @@
+'''
+Check that the conversion modes (full, streaming and incremental) give the
+same event/occurrence IDs and links on a synthetic order whose files read a
+column as integers in some files and as floats in others (see
+synthetic.make_order). Run it from services/biopipes:
+
+    python -m bench.check_modes --files 12 --rows 100 --blank-depth-files 1 --chunk-rows 300
+
+Exits with 1 if a mode differs from the full conversion.
+'''
+
+import os
+import sys
+import shutil
+import logging
+import argparse
+import tempfile
+
+import pandas as pd
+
+import bench.synthetic as synthetic
+
+log = logging.getLogger('check_modes')
+
+MODES = ['full', 'streaming', 'incremental']
+
+# The columns that tie the tables together
+ID_COLUMNS = {'event': ['eventID', 'parentEventID'],
+              'occ': ['eventID', 'occurrenceID'],
+              'emof': ['eventID', 'occurrenceID']}
+
+
+def convert(odv_to_dwc, odv_zip, mode):
+    '''
+    Convert the order in mode, returns the ID columns of every table as
+    sorted lists of rows
+    '''
+    os.environ['CONVERSION_MODE'] = mode
+    folder_dict = odv_to_dwc.create_folder_structure(odv_zip)
+    # Every mode starts from scratch
+    shutil.rmtree(folder_dict.get('dwc_path'))
+    shutil.rmtree(odv_to_dwc.manifest_helper.manifest_folder(folder_dict), ignore_errors=True)
+    odv_to_dwc.odv_to_dwc({'last_data_file': odv_zip})
+    tables = {}
+    for name, columns in ID_COLUMNS.items():
+        df = pd.read_csv(folder_dict.get(f'{name}_path'), dtype=str, keep_default_na=False)
+        tables[name] = sorted(map(tuple, df[columns].to_numpy().tolist()))
+    return tables
+
+def check(args):
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='odv_check_')
+    odv_zip = synthetic.make_order(os.path.join(work_dir, 'order'), args.files, args.rows, args.params,
+                                   args.taxa, args.seed, args.blank_depth_files)
+    os.environ['VOCAB_FIXTURE'] = synthetic.write_vocab_fixture(os.path.join(work_dir, 'vocab_fixture.json'),
+                                                                args.params)
+    os.environ['VOCAB_CACHE_DATABASE'] = os.path.join(work_dir, 'vocab_cache.db')
+    os.environ['ODV_CHUNK_ROWS'] = str(args.chunk_rows)
+    os.environ['DWC_OUTPUT'] = 'csv'
+    # Imported after the environment is set up
+    import app.odv_to_dwc as odv_to_dwc
+
+    results = {mode: convert(odv_to_dwc, odv_zip, mode) for mode in MODES}
+    ok = True
+    for mode in MODES[1:]:
+        for name in ID_COLUMNS:
+            full_rows, mode_rows = set(results['full'][name]), set(results[mode][name])
+            if full_rows != mode_rows:
+                ok = False
+                print(f'{mode} {name}: {len(mode_rows - full_rows)} of {len(mode_rows)} ID rows differ from full')
+    print('All modes give the same IDs' if ok else 'The modes give different IDs')
+    return ok
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Check that the conversion modes give the same IDs')
+    parser.add_argument('--files', type=int, default=12, help='ODV files in the order')
+    parser.add_argument('--rows', type=int, default=100, help='rows per ODV file')
+    parser.add_argument('--params', type=int, default=3, help='measured parameters per ODV file')
+    parser.add_argument('--taxa', type=int, default=20, help='distinct taxa')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--blank-depth-files', type=int, default=1,
+                        help='files with a blank depth, read as floats where the others are integers')
+    parser.add_argument('--chunk-rows', type=int, default=300, help='ODV_CHUNK_ROWS of the streaming mode')
+    parser.add_argument('--work-dir', help='where the order is generated (a temp folder by default)')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(stream=sys.stderr, format='%(asctime)s - %(levelname)s - %(name)s - %(message)s',
+                        level=logging.WARNING)
+    sys.exit(0 if check(args) else 1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,195 @@
+'''
+Benchmark of the stages of the full odv_to_dwc conversion on a synthetic
+order (see synthetic.py), with the NERC lookups served from a fixture.
+Run it from services/biopipes:
+
+    python -m bench.run_bench --files 50 --rows 1000 --params 8 --taxa 100 --out bench.json
+    python -m bench.run_bench --files 50 --rows 1000 --params 8 --taxa 100 --baseline bench.json
+
+The conversion is the one that ships (odv_to_dwc_full and its writers),
+timed through its stage_metrics stages. Stages nest (unzip runs within
+parse_odv) so they don't add up, 'total' is the whole conversion. Every
+stage is timed over --repeat runs (min and median wall time), then one more
+run under tracemalloc records the peak memory allocated during each stage. The JSON results carry the commit and the arguments, so
+results of the same arguments can be compared across commits with
+--baseline.
+'''
+
+import os
+import gc
+import sys
+import json
+import time
+import logging
+import argparse
+import platform
+import resource
+import statistics
+import subprocess
+import tempfile
+import tracemalloc
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+
+import app.stage_metrics as stage_metrics
+import bench.synthetic as synthetic
+
+log = logging.getLogger('run_bench')
+
+BENCH_VERSION = 2
+
+
+class TracedReport(stage_metrics.StageReport):
+    '''
+    StageReport that also records the peak memory allocated during every
+    stage, under tracemalloc (traced_peak_mb)
+    '''
+    def __init__(self, **info):
+        super().__init__(**info)
+        # (stage, traced memory at its start) of the open stages
+        self.traced = []
+
+    def fold_traced(self):
+        peak = tracemalloc.get_traced_memory()[1]
+        for name, start in self.traced:
+            stage = self.stages[name]
+            stage['traced_peak_mb'] = max(stage.get('traced_peak_mb', 0), (peak - start) / 2 ** 20)
+        tracemalloc.reset_peak()
+
+    @contextmanager
+    def stage(self, name, rows_in=None):
+        self.fold_traced()
+        self.traced.append((name, tracemalloc.get_traced_memory()[0]))
+        try:
+            with super().stage(name, rows_in) as rows:
+                yield rows
+        finally:
+            self.fold_traced()
+            self.traced.pop()
+
+
+def run_conversion(odv_to_dwc, odv_zip, trace_memory=False):
+    '''
+    Run the full conversion (odv_to_dwc_full, with the outputs of DWC_OUTPUT)
+    recording its stages, returns the stages of the report
+    '''
+    folder_dict = odv_to_dwc.create_folder_structure(odv_zip)
+    with stage_metrics.recording(folder_dict.get('stage_report_path'),
+                                 report_class=TracedReport if trace_memory else stage_metrics.StageReport,
+                                 mode='full') as report:
+        odv_to_dwc.odv_to_dwc_full(folder_dict)
+    return report.stages
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run(args):
+    '''
+    Generate the order, run the benchmark and return the results dict
+    '''
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='odv_bench_')
+    order_folder = os.path.join(work_dir, 'order')
+    odv_zip = synthetic.make_order(order_folder, args.files, args.rows, args.params, args.taxa, args.seed)
+    os.environ['VOCAB_FIXTURE'] = synthetic.write_vocab_fixture(os.path.join(work_dir, 'vocab_fixture.json'),
+                                                                args.params)
+    os.environ['VOCAB_CACHE_DATABASE'] = os.path.join(work_dir, 'vocab_cache.db')
+    os.environ['CONVERSION_MODE'] = 'full'
+    # Imported after the environment is set up
+    import app.odv_to_dwc as odv_to_dwc
+
+    runs = []
+    for i in range(args.repeat):
+        gc.collect()
+        runs.append(run_conversion(odv_to_dwc, odv_zip))
+        log.info(f'Run {i + 1}/{args.repeat}: {runs[-1]["total"]["wall"]:.2f}s')
+
+    memory = {}
+    if not args.no_memory:
+        gc.collect()
+        tracemalloc.start()
+        memory = run_conversion(odv_to_dwc, odv_zip, trace_memory=True)
+        tracemalloc.stop()
+
+    stages = {}
+    for name in runs[0]:
+        walls = [x[name]['wall'] for x in runs]
+        stages[name] = {'wall_min': min(walls),
+                        'wall_median': statistics.median(walls),
+                        'calls': runs[0][name]['calls'],
+                        'rows': runs[0][name]['rows_out'],
+                        'peak_mb': memory.get(name, {}).get('traced_peak_mb')}
+    total = stages.pop('total')
+    return {'version': BENCH_VERSION,
+            'commit': git_commit(),
+            'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'args': {'files': args.files, 'rows': args.rows, 'params': args.params,
+                     'taxa': args.taxa, 'seed': args.seed, 'repeat': args.repeat},
+            'platform': {'python': platform.python_version(), 'pandas': pd.__version__,
+                         'numpy': np.__version__, 'machine': platform.machine(), 'cpus': os.cpu_count()},
+            'total_wall_min': total['wall_min'],
+            'total_peak_mb': total['peak_mb'],
+            'max_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+            'stages': stages}
+
+def compare(results, baseline=None):
+    '''
+    Print the stages, side by side with a baseline result file if given
+    '''
+    baseline = baseline or {'stages': {}}
+    if baseline.get('version', results['version']) != results['version']:
+        print(f'WARNING: baseline is from benchmark version {baseline.get("version")}, its stages differ')
+    if baseline.get('args', results['args']) != results['args']:
+        print(f'WARNING: baseline was run with other arguments: {baseline.get("args")}')
+    print(f'{"stage":<22}{"base (s)":>10}{"new (s)":>10}{"ratio":>8}{"base MB":>10}{"new MB":>10}')
+    rows = list(results['stages'].items()) + [('total', {'wall_min': results['total_wall_min'],
+                                                         'peak_mb': results.get('total_peak_mb')})]
+    for name, stage in rows:
+        base = baseline['stages'].get(name, {}) if name != 'total' else {'wall_min': baseline.get('total_wall_min'),
+                                                                           'peak_mb': baseline.get('total_peak_mb')}
+        base_wall, new_wall = base.get('wall_min'), stage.get('wall_min')
+        ratio = f'{new_wall / base_wall:.2f}' if base_wall else '-'
+        base_mb, new_mb = base.get('peak_mb'), stage.get('peak_mb')
+        print(f'{name:<22}{base_wall or 0:>10.3f}{new_wall:>10.3f}{ratio:>8}'
+              f'{base_mb if base_mb is not None else float("nan"):>10.1f}'
+              f'{new_mb if new_mb is not None else float("nan"):>10.1f}')
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the ODV to DwC conversion on a synthetic order')
+    parser.add_argument('--files', type=int, default=20, help='ODV files in the order')
+    parser.add_argument('--rows', type=int, default=500, help='rows per ODV file')
+    parser.add_argument('--params', type=int, default=5, help='measured parameters per ODV file')
+    parser.add_argument('--taxa', type=int, default=50, help='distinct taxa')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--repeat', type=int, default=3, help='timed runs')
+    parser.add_argument('--no-memory', action='store_true', help='skip the tracemalloc run')
+    parser.add_argument('--work-dir', help='where the order is generated (a temp folder by default)')
+    parser.add_argument('--out', help='write the results to this JSON file')
+    parser.add_argument('--baseline', help='compare with the results in this JSON file')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(stream=sys.stderr, format='%(asctime)s - %(levelname)s - %(name)s - %(message)s',
+                        level=logging.INFO)
+    # The conversion logs every stage, keep the output to the benchmark
+    logging.getLogger('odv_to_dwc').setLevel(logging.WARNING)
+    logging.getLogger('vocab_helper').setLevel(logging.WARNING)
+    logging.getLogger('stage_metrics').setLevel(logging.WARNING)
+
+    results = run(args)
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2)
+        log.info(f'Results written to {args.out}')
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(results, json.load(f))
+    else:
+        compare(results)
+
+if __name__ == '__main__':
+    main()
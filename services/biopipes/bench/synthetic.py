@@ -0,0 +1,108 @@
+'''
+Synthetic SDN orders for the benchmarks. An order is laid out like a real
+download:
+
+> <folder>/order_1_unrestricted.zip (one ODV .txt file per CDI)
+> <folder>/meta.zip (order_1_unrestricted.csv, the CDI metadata)
+
+with the vocab fixture (see vocab_helper) for all the NERC terms it uses,
+so it can be converted without network access. The same arguments and
+seed always give the same order.
+'''
+
+import io
+import json
+import random
+import pathlib
+import zipfile
+
+ODV_COLUMNS = ['Cruise', 'Station', 'Type', 'yyyy-mm-ddThh:mm:ss.sss',
+               'Longitude [degrees_east]', 'Latitude [degrees_north]', 'LOCAL_CDI_ID', 'EDMO_code',
+               'Bot. Depth [m]', 'MinimumObservationDepth [m]', 'MaximumObservationDepth [m]',
+               'SampleID', 'ScientificName', 'ScientificNameID']
+
+META_COLUMNS = ['LOCAL_CDI_ID', 'Latitude 1', 'Latitude 2', 'Longitude 1', 'Longitude 2',
+                'EDMED references', 'Station name', 'Alternative station name',
+                'Minimum instrument depth (m)', 'Maximum instrument depth (m)', 'Water depth (m)',
+                'Instrument / gear type', 'Platform type', 'Depth reference', 'EDMO_code']
+
+
+def unit_uri(p):
+    return f'https://vocab.nerc.ac.uk/collection/P06/current/U{p:03d}/'
+
+def instrument_uri(p):
+    return f'http://vocab.nerc.ac.uk/collection/L22/current/TOOL{p:04d}/'
+
+def odv_file(rnd, cdi_id, rows, n_params, n_taxa, blank_depth=False):
+    '''
+    Text of one ODV file: the references, the parameter mapping and the
+    data, with the metadata columns only filled on the first row (like
+    the SDN exports). With blank_depth the last row has no maximum depth,
+    so that column is read as floats instead of integers.
+    '''
+    lines = [f'//<sdn_reference xlink:href="https://cdi.seadatanet.org/report/edmo/486/{cdi_id}" '
+             f'xlink:role="isDescribedBy" xlink:type="SDN:L23::CDI" sdn:scope="486:{cdi_id}"/>',
+             '//SDN_parameter_mapping']
+    for p in range(n_params):
+        instrument = f'<instrument>SDN:L22::TOOL{p:04d}</instrument>' if p % 2 == 0 else ''
+        lines.append(f'//<subject>SDN:LOCAL:Param{p}</subject><object>SDN:P01::PARM{p:04d}</object>'
+                     f'<units>SDN:P06::U{p:03d}</units>{instrument}')
+    lines.append('//')
+    header = list(ODV_COLUMNS)
+    for p in range(n_params):
+        header += [f'Param{p} [#]', 'QV:SEADATANET']
+    lines.append('\t'.join(header))
+
+    lon = round(rnd.uniform(-10, 30), 4)
+    lat = round(rnd.uniform(35, 60), 4)
+    for r in range(rows):
+        taxon = rnd.randrange(n_taxa)
+        first = r == 0
+        values = ['C1' if first else '', cdi_id.replace('CDI', 'ST') if first else '', 'B' if first else '',
+                  f'2020-0{1 + (r // 20) % 9}-1{r % 10}T00:00:00.000',
+                  str(lon) if first else '', str(lat) if first else '',
+                  cdi_id if first else '', '486' if first else '', '20' if first else '',
+                  str(r % 3), '' if blank_depth and r == rows - 1 else str(r % 3 + 5), f'{cdi_id}_S{r // 5}',
+                  f'Taxon species{taxon}', f'urn:lsid:marinespecies.org:taxname:{1000 + taxon}']
+        for p in range(n_params):
+            value = '' if rnd.random() < 0.2 else str(round(rnd.uniform(0, 100), 2))
+            values += [value, '1']
+        lines.append('\t'.join(values))
+    return '\n'.join(lines) + '\n', lat, lon
+
+def make_order(folder, n_files=10, rows=100, n_params=5, n_taxa=20, seed=1, blank_depth_files=0):
+    '''
+    Write a synthetic order to folder, returns the path of the ODV zip. The
+    last blank_depth_files files have a blank depth (see odv_file).
+    '''
+    rnd = random.Random(seed)
+    folder = pathlib.Path(folder)
+    folder.mkdir(parents=True, exist_ok=True)
+    odv_zip = folder.joinpath('order_1_unrestricted.zip')
+
+    meta = io.StringIO()
+    meta.write(','.join(META_COLUMNS) + '\n')
+    with zipfile.ZipFile(odv_zip, 'w', zipfile.ZIP_DEFLATED) as zip_ref:
+        for f in range(n_files):
+            cdi_id = f'CDI{f:06d}'
+            text, lat, lon = odv_file(rnd, cdi_id, rows, n_params, n_taxa, f >= n_files - blank_depth_files)
+            zip_ref.writestr(f'{cdi_id}.txt', text)
+            meta.write(','.join([f'{cdi_id}/{f}', str(lat - 0.1), str(lat + 0.1), str(lon - 0.2), str(lon + 0.2),
+                                 'EDMED 1', f'Station {f}', f'Alt {f}', '1', '5', '30',
+                                 'Grab (12)', 'research vessel (31)', 'sea level', '486']) + '\n')
+    with zipfile.ZipFile(folder.joinpath('meta.zip'), 'w', zipfile.ZIP_DEFLATED) as zip_ref:
+        zip_ref.writestr(odv_zip.stem + '.csv', meta.getvalue())
+    return str(odv_zip)
+
+def write_vocab_fixture(path, n_params):
+    '''
+    Labels for the units and instruments of the synthetic orders, in the
+    VOCAB_FIXTURE format
+    '''
+    fixture = {}
+    for p in range(n_params):
+        fixture[unit_uri(p)] = {'skos:altLabel': [f'label-U{p:03d}']}
+        fixture[instrument_uri(p)] = f'label-TOOL{p:04d}'
+    with open(path, 'w') as f:
+        json.dump(fixture, f)
+    return str(path)
@@ -18,8 +18,9 @@ import argparse
 import logging
 import datetime
 import os
-import json
 import traceback
+import random
+import functools
 from pathlib import Path
 import urllib
 
@@ -27,20 +28,30 @@ import urllib
 # import pysqlite3
 
 from apscheduler.schedulers.blocking import BlockingScheduler
+from apscheduler.executors.pool import ThreadPoolExecutor
 import app.db_helper as db_helper
 import app.cdi_helper as cdi_helper
 import app.odv_to_dwc as odv_to_dwc
 import app.alerting as alerting
+import app.metrics as metrics
+import app.stage_metrics as stage_metrics
+from app.job_executor import JobExecutor
+from app.order_watcher import OrderWatcher
 
 log = logging.getLogger('main')
 
-def trigger_pipeline(job_dict):
+def trigger_pipeline(job_dict, reprocess=False):
     '''
     Trigger the pipeline that needs to run after all the raw data has been
-    downloaded.
+    downloaded. Reprocessing starts from the parquet store of the last
+    conversion instead of the ODV zip. Returns the stage report of the
+    conversion, None if there was nothing to convert.
     '''
     log.info('Triggering ODV-to-DwC conversion for job "{0}"'.format(job_dict.get('name')))
-    status = odv_to_dwc.odv_to_dwc(job_dict)
+    # A report left over from an earlier conversion in this process is dropped
+    stage_metrics.take_report()
+    status = odv_to_dwc.odv_to_dwc(job_dict, reprocess=reprocess)
+    return stage_metrics.take_report()
 
     # alert_msg = alerting.Alerter(os.getenv('WEBHOOK'))
     # alert_msg.create_msg_card(title = 'Message',
@@ -54,10 +65,91 @@ def trigger_pipeline(job_dict):
 
 def check_new_data(job_dict, api_client):
     '''
-    Check if there is new/updated data to add to a dataset
+    Check if there is new/updated data to add to a dataset. A failed probe
+    raises and leaves the watermark alone.
     '''
     log.debug('Checking if job {0} has new data...'.format(job_dict.get('name')))
     last_update = api_client.get_last_update(job_dict)
+    db_helper.get_store().update_watermarks({cdi_helper.query_key(job_dict.get('query')): last_update})
+    return is_newer(job_dict, last_update)
+
+def probe_new_data(job_dicts, api_client):
+    '''
+    check_new_data for a batch of jobs: all the distinct queries are probed
+    concurrently and their watermarks recorded in one transaction.
+    Returns {job_id: True if there is new data}, without the jobs whose
+    probe failed (they get no watermark, so they're probed again).
+    '''
+    job_dicts = list(job_dicts)
+    if not job_dicts:
+        return {}
+    log.info('Probing {0} jobs for new data...'.format(len(job_dicts)))
+    last_updates = api_client.get_last_updates(job_dicts)
+    probed = [x for x in job_dicts if x.get('job_id') in last_updates]
+    if len(probed) < len(job_dicts):
+        log.warning('  -The probe of {0} jobs failed'.format(len(job_dicts) - len(probed)))
+    db_helper.get_store().update_watermarks({cdi_helper.query_key(x.get('query')): last_updates[x.get('job_id')]
+                                             for x in probed})
+    return {x.get('job_id'): is_newer(x, last_updates[x.get('job_id')]) for x in probed}
+
+def check_interval(job_dict):
+    '''
+    Time between two checks of a job, its check_interval or RECHECK_MINS
+    '''
+    return datetime.timedelta(minutes=job_dict.get('check_interval') or int(os.getenv('RECHECK_MINS', 240)))
+
+def watermark_is_fresh(job_dict, checked):
+    '''
+    True if the query of a job was probed within its check interval
+    '''
+    return checked is not None and datetime.datetime.now() - checked < check_interval(job_dict)
+
+def stored_new_data(job_dict):
+    '''
+    check_new_data from the watermark of the query of a job, if probe_jobs
+    (or another job with the same query) probed it within the check
+    interval of the job. None when it has to be probed.
+    '''
+    last_update, checked = db_helper.get_store().get_watermark(cdi_helper.query_key(job_dict.get('query')))
+    if not watermark_is_fresh(job_dict, checked):
+        return None
+    log.debug('Using the watermark of job {0}, checked {1}'.format(job_dict.get('name'), checked))
+    return is_newer(job_dict, last_update)
+
+def probe_jobs(scheduler, executor, api_client):
+    '''
+    Periodic probe of the jobs waiting for new data. The queries whose
+    watermark is older than the check interval of one of their jobs are
+    probed in one batch (see probe_new_data) and the jobs with new data are
+    run right away. The scheduled checks of the other jobs find a fresh
+    watermark (see stored_new_data) and don't probe their query themselves.
+    '''
+    running_jobs = executor.running_jobs()
+    store = db_helper.get_store()
+    watermarks = store.get_watermarks()
+    waiting = [x for x in store.get_jobs()
+               if x.get('active') and not x.get('order_placed') and x.get('job_id') not in running_jobs]
+    due_keys = set()
+    for job_dict in waiting:
+        key = cdi_helper.query_key(job_dict.get('query'))
+        if not watermark_is_fresh(job_dict, watermarks.get(key, (None, None))[1]):
+            due_keys.add(key)
+    if not due_keys:
+        return
+
+    # The jobs sharing a due query come along, without more API calls
+    new_data = probe_new_data([x for x in waiting if cdi_helper.query_key(x.get('query')) in due_keys], api_client)
+    now = datetime.datetime.now(scheduler.timezone)
+    for job_id, has_new_data in new_data.items():
+        scheduled = scheduler.get_job(f'job-{job_id}')
+        if has_new_data and scheduled is not None:
+            log.info('Job {0} has new data, checking it now'.format(job_id))
+            scheduled.modify(next_run_time=now)
+
+def is_newer(job_dict, last_update):
+    '''
+    Compare the last update of the data of a job with its last run
+    '''
     if (last_update is None):
         log.warning('  -Job {0} has no records.'.format(job_dict.get('name')))
         return False
@@ -92,7 +184,9 @@ def place_order(job_dict, api_client):
 
 def download_order(job_dict, order_status, api_client):
     '''
-    Download the order
+    Download the order, the files are streamed to disk (see
+    SeadatanetAPI.download_to_file). Returns the job_dict and whether
+    the download is complete.
 
     Example API response :
     {'dateCreated': '2022-08-22 10:29:08.947',
@@ -136,17 +230,21 @@ def download_order(job_dict, order_status, api_client):
     try:
         #Inverted 'unrestricted' and 'csv' because the order changed in the output dictonary of seadatanet API and removed  the +'/unrestricted'
         download_csv_url = download_urls.get('unrestricted',{}).get('csv',{}).get('downloadUrl')
+        download_csv_size = download_urls.get('unrestricted',{}).get('csv',{}).get('fileSize')
     except:
         download_csv_url = None
+        download_csv_size = None
         log.warning('Problem getting CSV download URL from order')
     try:
         #Inverted 'unrestricted' and 'data' because the order changed in the seadatane API response
         download_data_url = download_urls.get('unrestricted',{}).get('data',{}).get('downloadUrl')
         download_data_name = download_urls.get('unrestricted',{}).get('data',{}).get('name')
+        download_data_size = download_urls.get('unrestricted',{}).get('data',{}).get('fileSize')
     except:
         log.error('Problem getting ZIP download URL from order')
         download_data_url = None
         download_data_name = None
+        download_data_size = None
 
     try:
         Path(f"/code/datasets/{order_name}/{order_number}").mkdir(parents=True, exist_ok=True)
@@ -155,20 +253,18 @@ def download_order(job_dict, order_status, api_client):
         if download_csv_url is not None:
             # requests.get(download_csv_url)
             p = urllib.parse.urlparse(download_csv_url,'http')
-            csv_file = api_client.download_order(p.geturl())
             meta_path = f"/code/datasets/{order_name}/{order_number}/meta.zip"
-            open(meta_path, "wb").write(csv_file.content)
-            log.debug(f'Downloaded meta data file {len(csv_file.content)}')
+            size = api_client.download_to_file(p.geturl(), meta_path, download_csv_size)
+            log.debug(f'Downloaded meta data file {size}')
             job_dict['last_meta_file'] = meta_path
 
         if download_data_url is not None:
             # data_file = requests.get("http://" + download_data_url)
             # Removed '//'+ because the url have changed in the output of the seadatanet API
             p = urllib.parse.urlparse(download_data_url,'http')
-            data_file = api_client.download_order(p.geturl())
             data_path = f"/code/datasets/{order_name}/{order_number}/{download_data_name}"
-            open(data_path, "wb").write(data_file.content)
-            log.debug(f'Downloaded data file {len(data_file.content)}')
+            size = api_client.download_to_file(p.geturl(), data_path, download_data_size)
+            log.debug(f'Downloaded data file {size}')
             job_dict['last_data_file'] = data_path
 
         # Mkdir folder for this job_id and write csv and datafile into it.
@@ -184,119 +280,228 @@ def download_order(job_dict, order_status, api_client):
     else:
         log.error('Error downloading job {0}'.format(job_id))
 
-    return job_dict
+    return job_dict, download_complete
 
-def parse_job(job_tuple):
-    '''
-    Turns the job db tuple into a nice dict
-
-    CREATE TABLE IF NOT EXISTS jobs(
-    0                   id INTEGER PRIMARY KEY,
-    1                   name TEXT NOT NULL,
-    2                   active INTEGER,
-    3                   order_placed INTEGER,
-    4                   retrigger INTEGER,
-    5                   query TEXT NOT NULL,
-    6                   last_run TEXT,
-    7                   last_data_file TEXT,
-    8                   last_meta_file TEXT,
-    9                   order_id INTEGER,
-    10                  owner TEXT,
-    11                  owner_email TEXT
-    '''
-    job_dict = {}
-    try:
-        job_dict['job_id'] = job_tuple[0]
-        job_dict['name'] = job_tuple[1]
-        job_dict['active'] = job_tuple[2]
-        job_dict['order_placed'] = job_tuple[3]
-        job_dict['retrigger'] = job_tuple[4]
-        job_dict['query'] = json.loads(job_tuple[5])
-
-        # If the job has never been run before
-        if job_tuple[6] == '' or job_tuple[6] == None:
-            job_dict['last_run'] = datetime.datetime(1900,1,1)
-        else:
-            job_dict['last_run'] = datetime.datetime.strptime(job_tuple[6], '%Y-%m-%d %H:%M:%S.%f')
-        job_dict['last_data_file'] = job_tuple[7]
-        job_dict['last_meta_file'] = job_tuple[8]
-        job_dict['order_id'] = job_tuple[9]
-        job_dict['owner'] = job_tuple[10]
-        job_dict['owner_email'] = job_tuple[11]
+def check_job(job_dict, api_client, new_data=None):
+    '''
+    Run the cheap phases of a job: check for new data and place an order,
+    or check if the placed order is ready. Returns the order status when
+    the order is ready to download, None otherwise, with the job_dict.
+    new_data is the result of probe_new_data or stored_new_data, if the job
+    was probed already.
+    '''
+    log.info('Checking trigger for job "{0}"...'.format(job_dict.get('name')))
+    order_status = None
+
+    if job_dict.get('active'):
+        # Job is active and should be checked
+        if not(job_dict.get('order_placed')):
+            # Check if new data exists, and order should be placed
+            log.info('  -Job {0} is being checked for new data...'.format(job_dict.get('job_id')))
+            if new_data is None:
+                new_data = check_new_data(job_dict, api_client)
+            if new_data:
+                log.info('  -Job {0} has new data!'.format(job_dict.get('job_id')))
+                # Written to the DB by the caller with the rest of the job state
+                job_dict = place_order(job_dict, api_client)
+            else:
+                log.info('  -No new data for job {0}'.format(job_dict.get('job_id')))
+
+        else: # job_dict.get('order_placed')
+            # Check if new data is ready to download
+            log.info('Checking if order {0} is ready for download...'.format(job_dict.get('order_id')))
+            order_status = check_order_status(job_dict, api_client)
+            #Added a 's' at the end of the key 'download' because the output (dictionary) from the API have changed
+            if order_status is not None and order_status.get('downloads') is not None:
+                log.info('Order {0} is ready for download'.format(job_dict.get('order_id')))
+            else:
+                log.info('Order {0} is not ready for download'.format(job_dict.get('order_id')))
+                order_status = None
+    else:
+        log.info('Job {0} inactive...'.format(job_dict.get('job_id')))
 
-    except Exception as e:
-        log.error('Error parsing job tuple: {0}'.format(e))
-    return job_dict
+    return job_dict, order_status
 
-def check_status():
+def run_heavy_phases(job_dict, order_status):
     '''
-    Combine a prebuilt header/footer with snippets produced by other
-    containers into a new_datasets.xml file.
+    Download the order and convert it, or only rerun the conversion for a
+    retrigger. This runs in the conversion process pool, the returned
+    job_dict (and stage report) are handled by finish_job.
     '''
+    report = None
+    if order_status is not None:
+        with cdi_helper.SeadatanetAPI() as api_client:
+            job_dict, download_complete = download_order(job_dict, order_status, api_client)
+        if not download_complete:
+            # Keep the order placed, the next check resumes the download
+            return job_dict, report
+        report = trigger_pipeline(job_dict)
+
+        # Download complete, remove order placed and start watching
+        job_dict['order_placed'] = 0
+    elif job_dict.get('retrigger'):
+        # Rerun the ODV-to-DwC pipeline if there are downloaded
+        # files available to use.
+        report = trigger_pipeline(job_dict, reprocess=True)
+
+    # Job triggered (a new download is converted anyway), turn it off now.
+    job_dict['retrigger'] = 0
+    return job_dict, report
+
+def finish_job(result, watcher=None):
+    '''
+    All the work done, keep the job_dict up to date in the DB and add the
+    stage report of the conversion to the metrics. An order that is still
+    pending (incomplete download) goes back to the watcher.
+    '''
+    job_dict, report = result
+    metrics.observe_report(report)
+    db_helper.update_job(job_dict)
+    log.info('Job {0} finished'.format(job_dict.get('job_id')))
+    if watcher is not None and pending_order(job_dict):
+        watcher.watch(job_dict.get('job_id'))
+
+def dispatch_job(job_dict, order_status, executor, watcher=None):
+    '''
+    Start the heavy phases of a checked job if it needs them. Returns True
+    if it did, otherwise the state of the job still has to be written back
+    to the DB.
+    '''
+    if order_status is not None or job_dict.get('retrigger'):
+        executor.submit_heavy(job_dict.get('job_id'), run_heavy_phases, job_dict, order_status,
+                              callback=functools.partial(finish_job, watcher=watcher))
+        return True
+    return False
 
-    log.info('Fetching all jobs...')
-    jobs =  db_helper.run_sql('SELECT * FROM jobs')
-
-    log.info('Setting up API client...')
-    api_client = cdi_helper.SeadatanetAPI()
+def pending_order(job_dict):
+    '''
+    True if the job waits for its order, its polls are left to the OrderWatcher
+    '''
+    return bool(job_dict.get('active') and job_dict.get('order_placed') and not job_dict.get('retrigger'))
 
-    log.info('Checking if any jobs need to be run...')
-    for job in jobs:
-        try:
-            job_dict = parse_job(job)
-            log.info('=====================')
-            log.info('Checking trigger for job "{0}"...'.format(job_dict.get('name')))
-
-            if job_dict.get('active'):
-                # Job is active and should be checked
-                if not(job_dict.get('order_placed')):
-                    # Check if new data exists, and order should be placed
-                    log.info('  -Job {0} is being checked for new data...'.format(job_dict.get('job_id')))
-                    new_data = check_new_data(job_dict, api_client)
-                    if new_data:
-                        log.info('  -Job {0} has new data!'.format(job_dict.get('job_id')))
-                        job_dict = place_order(job_dict, api_client)
-                        db_helper.update_job(job_dict)
-                    else:
-                        log.info('  -No new data for job {0}'.format(job_dict.get('job_id')))
-
-                else: # job_dict.get('order_placed')
-                    # Check if new data is ready to download
-                    log.info('Checking if order {0} is ready for download...'.format(job_dict.get('order_id')))
-                    order_status = check_order_status(job_dict, api_client)
-                    #Added a 's' at the end of the key 'download' because the output (dictionary) from the API have changed
-                    if order_status.get('downloads') is not None:
-                        order_ready = True
-                    else:
-                        order_ready = False
-
-                    if order_ready:
-                        log.info('Order {0} is ready for download'.format(job_dict.get('order_id')))
-                        job_dict = download_order(job_dict, order_status, api_client)
-                        trigger_pipeline(job_dict)
-
-                        # Download complete, remove order placed and start watching
-                        job_dict['order_placed'] = 0
-                    else:
-                        log.info('Order {0} is not ready for download'.format(job_dict.get('order_id')))
-            else:
-                log.info('Job inactive...')
-                pass
+def run_job(job_id, executor, api_client, watcher=None):
+    '''
+    Scheduled check of a single job, the row is read again so edits to
+    the job are picked up on every run. All the jobs share api_client.
+    New data is looked up in the watermarks of probe_jobs, the query is only
+    probed here when its watermark is stale. With a watcher, the orders
+    placed are polled by the watcher.
+    '''
+    if job_id in executor.running_jobs():
+        log.info('Job {0} is still being downloaded/converted, skipping it...'.format(job_id))
+        return
+    job_dict = db_helper.get_store().get_job(job_id)
+    if job_dict is None:
+        log.warning('Job {0} no longer exists'.format(job_id))
+        return
+    if watcher is not None and pending_order(job_dict):
+        watcher.watch(job_id)
+        return
+    try:
+        new_data = None
+        if job_dict.get('active') and not job_dict.get('order_placed'):
+            new_data = stored_new_data(job_dict)
+        if not dispatch_job(*check_job(job_dict, api_client, new_data), executor, watcher):
+            db_helper.update_job(job_dict)
+            if watcher is not None and pending_order(job_dict):
+                watcher.watch(job_id)
+    except Exception as e:
+        log.error('Job Error: {0}'.format(e))
 
-            if job_dict.get('retrigger'):
-                # Rerun the ODV-to-DwC pipeline if there are downloaded
-                # files available to use.
-                trigger_pipeline(job_dict)
+def sync_schedules(scheduler, executor, api_client, watcher=None):
+    '''
+    Keep one scheduled check per row of the jobs table. New jobs are added,
+    removed jobs are dropped and jobs with a new check_interval are
+    rescheduled, so the jobs table can be edited while the service runs.
+    Jobs flagged for a retrigger are run right away, pending orders (e.g.
+    after a restart) are handed to the watcher.
+    '''
+    default_interval = int(os.getenv('RECHECK_MINS', 240))
+    jitter = int(os.getenv('JOB_JITTER_SECS', 300))
+    now = datetime.datetime.now(scheduler.timezone)
+
+    rows = db_helper.run_sql('SELECT id, check_interval, retrigger, active, order_placed FROM jobs')
+    wanted = {f'job-{job_id}': (job_id, interval or default_interval, retrigger) for job_id, interval, retrigger, _, _ in rows}
+
+    if watcher is not None:
+        running_jobs = executor.running_jobs()
+        for job_id, _, retrigger, active, order_placed in rows:
+            if pending_order({'active': active, 'order_placed': order_placed, 'retrigger': retrigger}) \
+                    and job_id not in running_jobs:
+                watcher.watch(job_id)
+
+    for scheduled in scheduler.get_jobs():
+        if scheduled.id.startswith('job-') and scheduled.id not in wanted:
+            log.info('Job {0} removed from the jobs table, unscheduling it'.format(scheduled.id))
+            scheduled.remove()
+
+    for scheduled_id, (job_id, interval, retrigger) in wanted.items():
+        scheduled = scheduler.get_job(scheduled_id)
+        if scheduled is None:
+            # Spread the first checks so they don't all hit the API at once
+            first_run = now + datetime.timedelta(seconds=random.uniform(0, jitter))
+            log.info('Scheduling job {0} every {1} minutes'.format(job_id, interval))
+            scheduler.add_job(run_job, 'interval', minutes=interval, jitter=jitter,
+                              args=[job_id, executor, api_client, watcher], id=scheduled_id, name=f'check job {job_id}',
+                              next_run_time=first_run)
+            continue
+        if scheduled.trigger.interval != datetime.timedelta(minutes=interval):
+            log.info('Rescheduling job {0} every {1} minutes'.format(job_id, interval))
+            scheduled.reschedule('interval', minutes=interval, jitter=jitter)
+        if retrigger and job_id not in executor.running_jobs():
+            scheduled.modify(next_run_time=now)
+
+def check_status(executor=None, api_client=None):
+    '''
+    Check all the jobs concurrently and start the downloads/conversions of
+    the ones that need it. Without an executor (a one off run) this waits
+    for the conversions, otherwise they keep running on the executor after
+    this returns. The checks share one API client, a new one is set up if
+    none is given.
+    '''
+    own_executor = executor is None
+    if own_executor:
+        executor = JobExecutor()
 
-                # Job triggered, turn it off now.
-                job_dict['retrigger'] = 0
+    # Taken before reading the jobs, the DB rows of the other jobs are up to date
+    running_jobs = executor.running_jobs()
 
-            # All the work done, keep the job_dict up to date in the DB
-            db_helper.update_job(job_dict)
-            log.info('=====================')
+    log.info('Fetching all jobs...')
+    jobs = db_helper.get_store().get_jobs()
+    job_dicts = list(jobs)
+    for job_dict in job_dicts:
+        if job_dict.get('job_id') in running_jobs:
+            log.info('Job {0} is still being downloaded/converted, skipping it...'.format(job_dict.get('job_id')))
+    job_dicts = [x for x in job_dicts if x.get('job_id') not in running_jobs]
+
+    own_client = api_client is None
+    if own_client:
+        log.info('Setting up API client...')
+        api_client = cdi_helper.SeadatanetAPI()
+
+    # Probe all the jobs waiting for new data at once, the ones without new
+    # data (or a retrigger) need nothing else this cycle
+    new_data = probe_new_data([x for x in job_dicts if x.get('active') and not x.get('order_placed')], api_client)
+    job_dicts = [x for x in job_dicts if new_data.get(x.get('job_id'), True) or x.get('retrigger')]
 
-        except Exception as e:
-            log.error('Job Error: {0}'.format(e))
+    log.info('Checking if any jobs need to be run...')
+    results = executor.map_checks(lambda job_dict: check_job(job_dict, api_client, new_data.get(job_dict.get('job_id'))),
+                                  job_dicts)
+    if own_client:
+        api_client.close()
+    finished_jobs = []
+    for result in results:
+        if result is None:
+            # Failed job, already logged
+            continue
+        if not dispatch_job(*result, executor):
+            finished_jobs.append(result[0])
+    # The state of all the checked jobs is written in one transaction
+    db_helper.update_jobs(finished_jobs)
+
+    if own_executor:
+        executor.wait_heavy()
+        executor.shutdown()
 
     log.debug('Jobs Summary:')
     log.debug(jobs)
@@ -315,14 +520,33 @@ def main(args):
     log.info('ARGS: {0}'.format(ARGS))
 
     db_helper.ensure_db()
+    metrics.start_server()
 
-    scheduler = BlockingScheduler()
-    scheduler.add_job(lambda: check_status(), 'interval', minutes=int(os.getenv('RECHECK_MINS')))
+    executor = JobExecutor()
+    log.info('Setting up API client...')
+    api_client = cdi_helper.SeadatanetAPI()
+    # Every job is its own scheduled check, a check that overruns is never
+    # started twice and missed runs are coalesced into one
+    scheduler = BlockingScheduler(
+        executors={'default': ThreadPoolExecutor(int(os.getenv('JOB_CHECK_WORKERS', 8)))},
+        job_defaults={'max_instances': 1,
+                      'coalesce': True,
+                      'misfire_grace_time': int(os.getenv('JOB_MISFIRE_GRACE_SECS', 600))})
+    # Placed orders are polled with a backoff and downloaded as soon as ready
+    watcher = OrderWatcher(scheduler, executor, api_client,
+                           on_ready=lambda job_dict, order_status: dispatch_job(job_dict, order_status, executor, watcher))
+    scheduler.add_job(sync_schedules, 'interval', seconds=int(os.getenv('JOBS_RELOAD_SECS', 60)),
+                      args=[scheduler, executor, api_client, watcher], id='sync_schedules', next_run_time=datetime.datetime.now())
+    # New data of all the jobs is probed in batches, the checks use the watermarks
+    scheduler.add_job(probe_jobs, 'interval', seconds=int(os.getenv('JOB_PROBE_SECS', 60)),
+                      args=[scheduler, executor, api_client], id='probe_jobs', next_run_time=datetime.datetime.now())
     try:
-        check_status()
         scheduler.start()
     except (KeyboardInterrupt, SystemExit):
         pass
+    finally:
+        executor.shutdown(wait=False)
+        api_client.close()
     log.info('Script Ended...')
 
 if __name__ == "__main__":